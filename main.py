@@ -4,17 +4,40 @@
 #   "fastapi[standard]",
 #   "uvicorn",
 #   "requests",
-#   "python-dotenv"
+#   "python-dotenv",
+#   "prometheus-client"
 # ]
 # ///
 
+import asyncio
 import base64
+import contextvars
+import hashlib
+import inspect
+import json
+import logging
+import mimetypes
 import os
+import queue
+import random
+import re
+import socket
+import sqlite3
+import threading
 import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import asynccontextmanager, contextmanager
+from html.parser import HTMLParser
+from urllib.parse import unquote_to_bytes, urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Response
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
 
 load_dotenv()
 
@@ -22,25 +45,283 @@ GITHUB_TOKEN = os.getenv("GH_PERSONAL_ACCESS_TOKEN")
 AIPIPE_API_KEY = os.getenv("AIPIPE_API_KEY")
 SECRET = os.getenv("secret")
 GITHUB_USERNAME = "hasratmd697"
+GITHUB_API_URL = os.getenv("GITHUB_API_URL", "https://api.github.com")
+
+# Worker pool settings
+MAX_CONCURRENT_JOBS = int(os.getenv("MAX_CONCURRENT_JOBS", "4"))
+MAX_QUEUED_JOBS = int(os.getenv("MAX_QUEUED_JOBS", "100"))
+JOB_HISTORY_LIMIT = int(os.getenv("JOB_HISTORY_LIMIT", "1000"))
+COORDINATION_THREADS = int(os.getenv("COORDINATION_THREADS", "8"))
+
+# Persistent record of every task and the stages it finished, keyed on (task, nonce, round)
+TASK_LEDGER_PATH = os.getenv("TASK_LEDGER_PATH", "tasks.db")
+
+# State shared by every worker process: job queue, per-repo leases and a cache.
+# sqlite:///path for workers on one host, redis://host:port/db for several hosts
+COORDINATION_URL = os.getenv("COORDINATION_URL", f"sqlite:///{TASK_LEDGER_PATH}")
+LEASE_TTL = float(os.getenv("LEASE_TTL", "60"))  # renewed every LEASE_TTL / 3 while held
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1"))
+REPO_LEASE_WAIT = float(os.getenv("REPO_LEASE_WAIT", "900"))
+JOB_SNAPSHOT_TTL = 7 * 24 * 3600
+WORKER_HOST = socket.gethostname()
+WORKER_ID = f"{WORKER_HOST}:{os.getpid()}"
+
+# Optional pool of pre-created repos (MIT license committed, Pages enabled) claimed by round 1 tasks
+WARM_POOL_SIZE = int(os.getenv("WARM_POOL_SIZE", "0"))
+WARM_POOL_PREFIX = os.getenv("WARM_POOL_PREFIX", "warm-pool-")
+WARM_POOL_CHECK_INTERVAL = float(os.getenv("WARM_POOL_CHECK_INTERVAL", "10"))
+WARM_CLAIM_TIMEOUT = 300  # a claim not finished by then was cut off and the repo is free again
+
+# Parallel blob uploads per push
+BLOB_UPLOAD_WORKERS = int(os.getenv("BLOB_UPLOAD_WORKERS", "8"))
+
+# Attachments are decoded or downloaded into a content-addressed store before upload
+ATTACHMENT_STORE_DIR = os.getenv("ATTACHMENT_STORE_DIR", ".attachments")
+ATTACHMENT_MAX_BYTES = int(os.getenv("ATTACHMENT_MAX_BYTES", str(10 * 1024 * 1024)))
+ATTACHMENT_CHUNK_BYTES = 3 * 64 * 1024  # multiple of 3 so base64 chunks concatenate cleanly
+
+# Shared HTTP client settings: per-host keep-alive pool size and timeout (seconds)
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "16"))
+HTTP_DEFAULT_TIMEOUT = float(os.getenv("HTTP_DEFAULT_TIMEOUT", "10"))
+HTTP_HOST_SETTINGS = {
+    urlsplit(GITHUB_API_URL).netloc: {"pool_size": max(HTTP_POOL_SIZE, BLOB_UPLOAD_WORKERS * MAX_CONCURRENT_JOBS), "timeout": 30},
+    "aipipe.org": {"pool_size": HTTP_POOL_SIZE, "timeout": 120},
+}
+GITHUB_ETAG_CACHE_SIZE = int(os.getenv("GITHUB_ETAG_CACHE_SIZE", "512"))
+
+# GitHub request scheduling: write caps, content-creation rate and rate-limit retries
+GITHUB_MAX_CONCURRENT_WRITES = int(os.getenv("GITHUB_MAX_CONCURRENT_WRITES", "4"))
+GITHUB_WRITES_PER_MINUTE = float(os.getenv("GITHUB_WRITES_PER_MINUTE", "60"))
+GITHUB_WRITE_BURST = int(os.getenv("GITHUB_WRITE_BURST", "15"))
+GITHUB_MAX_RETRIES = int(os.getenv("GITHUB_MAX_RETRIES", "4"))
+GITHUB_MAX_RETRY_WAIT = float(os.getenv("GITHUB_MAX_RETRY_WAIT", "60"))
+# Hourly budget left untouched by each request class, so that when it runs low
+# reads finish in-flight tasks before new writes and repo creations start
+GITHUB_BUDGET_RESERVE = {"read": 0, "write": 50, "repo_create": 200}
+
+# Readiness polling deadlines (seconds) for new repos and Pages builds
+REPO_READY_TIMEOUT = float(os.getenv("REPO_READY_TIMEOUT", "30"))
+PAGES_BUILD_TIMEOUT = float(os.getenv("PAGES_BUILD_TIMEOUT", "180"))
+
+# Per-stage timeouts (seconds) for the job pipeline
+LLM_STAGE_TIMEOUT = float(os.getenv("LLM_STAGE_TIMEOUT", "300"))
+STAGE_TIMEOUTS = {
+    "attachments": 120,
+    "generate": LLM_STAGE_TIMEOUT,
+    "create_repo": 120,
+    "push": 180,
+    "pages_wait": PAGES_BUILD_TIMEOUT + 30,
+    "notify": 120,
+}
+
+# LLM settings and completion cache (memory LRU in front of an on-disk store)
+LLM_MODEL = os.getenv("LLM_MODEL", "openai/gpt-4o-mini")
+LLM_MAX_TOKENS = int(os.getenv("LLM_MAX_TOKENS", "4096"))
+LLM_STREAM = os.getenv("LLM_STREAM", "1") == "1"
+
+# Model/endpoint routes, tried in order: hedges and failovers go to the next one.
+# LLM_ROUTES is a JSON list of {"name", "model", "url", optional "api_key_env", "timeout"}.
+LLM_ENDPOINT = os.getenv("LLM_ENDPOINT", "https://aipipe.org/openrouter/v1/chat/completions")
+LLM_FALLBACK_MODELS = [m for m in os.getenv("LLM_FALLBACK_MODELS", "openai/gpt-4.1-mini").split(",") if m]
+LLM_ROUTES = json.loads(os.getenv("LLM_ROUTES", "null")) or [
+    {"name": model, "model": model, "url": LLM_ENDPOINT} for model in [LLM_MODEL, *LLM_FALLBACK_MODELS]
+]
+LLM_HEDGE = os.getenv("LLM_HEDGE", "1") == "1"
+LLM_HEDGE_INITIAL_DELAY = float(os.getenv("LLM_HEDGE_INITIAL_DELAY", "10"))
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "2"))
+LLM_HEDGE_MAX_DELAY = float(os.getenv("LLM_HEDGE_MAX_DELAY", "30"))
+LLM_LATENCY_SAMPLES = 200
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", ".llm_cache")
+LLM_CACHE_MEMORY_ITEMS = int(os.getenv("LLM_CACHE_MEMORY_ITEMS", "256"))
+LLM_CACHE_DISK_BYTES = int(os.getenv("LLM_CACHE_DISK_BYTES", str(100 * 1024 * 1024)))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+
+# Round 2 edits: files up to this size are sent whole, larger ones as outline + relevant sections
+ROUND2_FULL_FILE_CHARS = int(os.getenv("ROUND2_FULL_FILE_CHARS", "12000"))
+ROUND2_SECTION_LINES = 40
+
+# Logging: "text" or one JSON object per line ("json")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+TRACE_SPAN_LIMIT = 500  # spans kept per job for GET /jobs/{id}?trace=true
+
+
+# Job whose pipeline stage is running in the current task or thread
+current_job: contextvars.ContextVar[dict | None] = contextvars.ContextVar("current_job", default=None)
+
+
+class JobContextFilter(logging.Filter):
+    """Tag every log record with the job, task and round it was logged for."""
+
+    def filter(self, record):
+        job = current_job.get()
+        record.job_id = job["id"] if job else None
+        record.task = job["task"] if job else None
+        record.round = job["round"] if job else None
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "msg": record.getMessage(),
+            "job_id": record.job_id,
+            "task": record.task,
+            "round": record.round,
+        }
+        entry.update(getattr(record, "span", None) or {})
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+log = logging.getLogger("deployer")
+log.setLevel(LOG_LEVEL)
+log.propagate = False
+_log_handler = logging.StreamHandler()
+_log_handler.addFilter(JobContextFilter())
+_log_handler.setFormatter(
+    JSONFormatter() if LOG_FORMAT == "json"
+    else logging.Formatter("%(asctime)s %(levelname)s [%(task)s r%(round)s] %(message)s")
+)
+log.addHandler(_log_handler)
+
+STAGE_SECONDS = Histogram(
+    "deployer_stage_seconds", "Time spent in each pipeline stage",
+    ["stage", "round", "status"], buckets=(0.1, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300),
+)
+EXTERNAL_SECONDS = Histogram(
+    "deployer_external_request_seconds", "Latency of calls to GitHub, LLM routes, attachments and the evaluator",
+    ["service", "endpoint", "status"], buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+LLM_TOKENS = Histogram(
+    "deployer_llm_tokens", "Tokens per LLM completion", ["route", "kind"],
+    buckets=(100, 250, 500, 1000, 2000, 4000, 8000, 16000),
+)
+RETRIES = Histogram(
+    "deployer_retries", "Retries needed per operation", ["operation"], buckets=(0, 1, 2, 3, 4, 6, 8),
+)
+JOBS_TOTAL = Counter("deployer_jobs_total", "Finished jobs", ["round", "status"])
+LLM_CACHE_EVENTS = Counter("deployer_llm_cache_events_total", "LLM completion cache lookups", ["result"])
+# Under several worker processes, set PROMETHEUS_MULTIPROC_DIR so /metrics covers all of them
+JOBS_QUEUED = Gauge("deployer_jobs_queued", "Jobs waiting for a worker", multiprocess_mode="livemostrecent")
+JOBS_RUNNING = Gauge("deployer_jobs_running", "Jobs being processed", multiprocess_mode="livesum")
+
+SPAN_METRICS = {
+    "stage": (STAGE_SECONDS, ("stage", "round")),
+    "external": (EXTERNAL_SECONDS, ("service", "endpoint")),
+}
+
+
+@contextmanager
+def span(kind: str, **tags):
+    """Time a block as a tracing span and record it in the matching histogram.
+
+    Spans are tagged with the current job's task and round, appended to the
+    job's trace and logged at DEBUG. The block may set "status" on the
+    yielded dict; otherwise it is "ok", or "error" if the block raised.
+    """
+    job = current_job.get()
+    if job is not None:
+        tags.setdefault("task", job["task"])
+        tags.setdefault("round", job["round"])
+    record = {"span": kind, **tags}
+    start = time.perf_counter()
+    try:
+        yield record
+        record.setdefault("status", "ok")
+    except BaseException as e:
+        record.setdefault("status", "error")
+        record["error"] = type(e).__name__
+        raise
+    finally:
+        record["duration"] = round(time.perf_counter() - start, 4)
+        record["start"] = round(time.time() - record["duration"], 3)
+        histogram, labels = SPAN_METRICS[kind]
+        histogram.labels(*(str(record.get(label)) for label in labels), str(record["status"])).observe(record["duration"])
+        if job is not None and len(job["trace"]) < TRACE_SPAN_LIMIT:
+            job["trace"].append(record)
+        log.debug(f"span {kind} {record['status']} in {record['duration']}s", extra={"span": record})
+
+
+GITHUB_ENDPOINT_PATTERNS = [
+    (re.compile(r"^/repos/[^/]+/[^/]+"), "/repos/:owner/:repo"),
+    (re.compile(r"/(commits|blobs|trees)/[0-9a-f]{7,40}$"), r"/\1/:sha"),
+    (re.compile(r"/contents/.+$"), "/contents/:path"),
+]
+
+
+def github_endpoint_label(endpoint: str) -> str:
+    """Collapse repo names, SHAs and paths so metric labels stay low-cardinality."""
+    for pattern, replacement in GITHUB_ENDPOINT_PATTERNS:
+        endpoint = pattern.sub(replacement, endpoint)
+    return endpoint
 
 
 # Debug prints
 if GITHUB_TOKEN:
-    print(f"✅ GITHUB_TOKEN loaded: {GITHUB_TOKEN[:10]}...")
+    log.info(f"✅ GITHUB_TOKEN loaded: {GITHUB_TOKEN[:10]}...")
 else:
-    print("❌ GITHUB_TOKEN not found!")
+    log.error("❌ GITHUB_TOKEN not found!")
 
 if AIPIPE_API_KEY:
-    print(f"✅ AIPIPE_API_KEY loaded: {AIPIPE_API_KEY[:10]}...")
+    log.info(f"✅ AIPIPE_API_KEY loaded: {AIPIPE_API_KEY[:10]}...")
 else:
-    print("❌ AIPIPE_API_KEY not found!")
+    log.error("❌ AIPIPE_API_KEY not found!")
 
 if SECRET:
-    print(f"✅ SECRET loaded: {SECRET}")
+    log.info(f"✅ SECRET loaded: {SECRET}")
 else:
-    print("❌ SECRET not found!")
+    log.error("❌ SECRET not found!")
+
+jobs: dict[str, dict] = {}
+# Stages hold their thread for minutes (LLM calls, Pages polling): round 1 runs two
+# at once per job, and the warm pool refills alongside. They get their own pool so
+# ledger and coordination calls (lease renewals, health checks) never queue behind them.
+stage_pool = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_JOBS * 2 + 2, thread_name_prefix="stage")
+coordination_pool = ThreadPoolExecutor(max_workers=COORDINATION_THREADS, thread_name_prefix="coordination")
+
+
+async def run_in(pool: ThreadPoolExecutor, func, *args, **kwargs):
+    """Like asyncio.to_thread, but on the given pool; current_job goes along."""
+    ctx = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(pool, lambda: ctx.run(func, *args, **kwargs))
+# Set when this process queues a job, so its idle workers don't wait for the next poll
+jobs_available = asyncio.Event()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start the job worker pool on startup and stop it on shutdown.
+
+    Tasks the ledger still has as queued or running are submitted again;
+    the shared queue ignores the ones it already has, and jobs cut off by
+    a shutdown are claimed again once their lease expires.
+    """
+    global coordination
+    ledger_init()
+    coordination = coordination_from_url(COORDINATION_URL)
+    workers = [asyncio.create_task(job_worker(i)) for i in range(MAX_CONCURRENT_JOBS)]
+    log.info(f"✅ Started {len(workers)} job workers")
+    if WARM_POOL_SIZE > 0:
+        workers.append(asyncio.create_task(warm_pool_filler()))
+        log.info(f"✅ Keeping {WARM_POOL_SIZE} warm repos ready")
+    for record in await run_in(coordination_pool, ledger_unfinished):
+        _, existing = await run_in(coordination_pool, 
+            coordination.submit, task_key(record["request"]), record["job_id"], record["request"],
+        )
+        if existing is None:
+            log.info(f"Resuming job {record['job_id']} ({record['task']}, round {record['round']})")
+    yield
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    stage_pool.shutdown(wait=False, cancel_futures=True)
+    coordination_pool.shutdown(wait=False)
+    close_http_sessions()
 
-app = FastAPI()
+
+app = FastAPI(lifespan=lifespan)
 
 
 def validate_secret(secret: str) -> bool:
@@ -48,155 +329,1187 @@ def validate_secret(secret: str) -> bool:
     return secret == SECRET
 
 
+class GitHubAPIError(Exception):
+    """Raised when the GitHub API returns a non-success status code."""
+
+    def __init__(self, status_code: int, text: str):
+        super().__init__(f"GitHub API error: {status_code}, {text}")
+        self.status_code = status_code
+        self.text = text
+
+
+http_sessions: dict[str, requests.Session] = {}
+http_sessions_lock = threading.Lock()
+
+# GitHub GET responses keyed by URL+params -> (etag, body), oldest first
+github_etag_cache: OrderedDict[str, tuple[str, dict]] = OrderedDict()
+github_etag_lock = threading.Lock()
+
+
+def http_session(host: str) -> requests.Session:
+    """Return the shared keep-alive session for a host, creating it on first use."""
+    with http_sessions_lock:
+        session = http_sessions.get(host)
+        if session is None:
+            pool_size = HTTP_HOST_SETTINGS.get(host, {}).get("pool_size", HTTP_POOL_SIZE)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            http_sessions[host] = session
+        return session
+
+
+def http_request(method: str, url: str, **kwargs) -> requests.Response:
+    """Send a request over the pooled session for the URL's host.
+
+    Connections are reused across calls and threads, so repeat calls to the
+    same host skip the TCP and TLS handshake. The host's timeout applies
+    unless the caller passes one.
+    """
+    host = urlsplit(url).netloc
+    kwargs.setdefault("timeout", HTTP_HOST_SETTINGS.get(host, {}).get("timeout", HTTP_DEFAULT_TIMEOUT))
+    return http_session(host).request(method, url, **kwargs)
+
+
+def close_http_sessions():
+    """Close all pooled connections."""
+    with http_sessions_lock:
+        for session in http_sessions.values():
+            session.close()
+        http_sessions.clear()
+
+
+# Rate-limit state shared by every GitHub call, fed from response headers
+github_limits = {
+    "remaining": None,  # X-RateLimit-Remaining of the core budget, None until seen
+    "reset": 0.0,  # epoch seconds when the core budget refills
+    "paused_until": 0.0,  # epoch seconds until which all calls wait (Retry-After)
+    "write_tokens": float(GITHUB_WRITE_BURST),
+    "refilled_at": time.monotonic(),
+}
+github_limits_cond = threading.Condition()
+github_slots = {
+    "write": threading.BoundedSemaphore(GITHUB_MAX_CONCURRENT_WRITES),
+    "repo_create": threading.BoundedSemaphore(1),
+}
+
+
+def github_request_class(method: str, endpoint: str) -> str:
+    """Classify a call as a read, a content write or a repo creation."""
+    if method.upper() in ("GET", "HEAD"):
+        return "read"
+    if method.upper() == "POST" and endpoint == "/user/repos":
+        return "repo_create"
+    return "write"
+
+
+def github_wait_turn(request_class: str):
+    """Block until a call of this class may be sent.
+
+    Every call waits out a Retry-After pause and keeps its class's reserve
+    of the hourly budget. Writes also take a token from a bucket refilled
+    at GITHUB_WRITES_PER_MINUTE, which keeps us under the secondary limit
+    on content creation.
+    """
+    with github_limits_cond:
+        while True:
+            now = time.time()
+            wait_for = github_limits["paused_until"] - now
+            remaining = github_limits["remaining"]
+            if wait_for <= 0 and remaining is not None and remaining <= GITHUB_BUDGET_RESERVE[request_class]:
+                wait_for = github_limits["reset"] - now
+            
+            if wait_for <= 0 and request_class != "read":
+                elapsed = time.monotonic() - github_limits["refilled_at"]
+                github_limits["refilled_at"] = time.monotonic()
+                github_limits["write_tokens"] = min(
+                    GITHUB_WRITE_BURST, github_limits["write_tokens"] + elapsed * GITHUB_WRITES_PER_MINUTE / 60
+                )
+                if github_limits["write_tokens"] < 1:
+                    wait_for = (1 - github_limits["write_tokens"]) * 60 / GITHUB_WRITES_PER_MINUTE
+                else:
+                    github_limits["write_tokens"] -= 1
+            
+            if wait_for <= 0:
+                if remaining is not None:
+                    # Count the call now so concurrent callers don't overdraw; the response corrects it
+                    github_limits["remaining"] = remaining - 1
+                return
+            github_limits_cond.wait(min(wait_for, 5))
+
+
+@contextmanager
+def github_slot(request_class: str):
+    """Hold one of the limited concurrent slots for writes and repo creations."""
+    github_wait_turn(request_class)
+    slot = github_slots.get(request_class)
+    if slot is None:
+        yield
+        return
+    with slot:
+        yield
+
+
+def github_observe_limits(response: requests.Response):
+    """Update the shared budget from a response's rate-limit headers."""
+    headers = response.headers
+    if "X-RateLimit-Remaining" not in headers or headers.get("X-RateLimit-Resource", "core") != "core":
+        return
+    with github_limits_cond:
+        github_limits["remaining"] = int(headers["X-RateLimit-Remaining"])
+        github_limits["reset"] = float(headers.get("X-RateLimit-Reset", 0))
+        github_limits_cond.notify_all()
+
+
+def github_rate_limited(response: requests.Response) -> bool:
+    """True for primary and secondary rate-limit rejections."""
+    if response.status_code == 429:
+        return True
+    return response.status_code == 403 and (
+        "Retry-After" in response.headers
+        or response.headers.get("X-RateLimit-Remaining") == "0"
+        or "rate limit" in response.text.lower()
+    )
+
+
+def github_retry_delay(response: requests.Response, attempt: int) -> float:
+    """Seconds to wait before retrying a rate-limited call.
+
+    Uses Retry-After, then the budget reset time, and otherwise backs off
+    exponentially from one minute as GitHub asks for secondary limits.
+    """
+    if "Retry-After" in response.headers:
+        delay = float(response.headers["Retry-After"])
+    elif response.headers.get("X-RateLimit-Remaining") == "0":
+        delay = float(response.headers.get("X-RateLimit-Reset", 0)) - time.time() + 1
+    else:
+        delay = 60 * 2 ** attempt * random.uniform(0.5, 1)
+    return min(max(delay, 1), GITHUB_MAX_RETRY_WAIT)
+
+
 def github_request(method: str, endpoint: str, **kwargs):
-    """Generic GitHub API request handler."""
+    """Generic GitHub API request handler.
+
+    Every call goes through the shared scheduler (github_slot), and calls
+    rejected by a rate limit pause all GitHub traffic and are retried.
+
+    GETs send If-None-Match with the last ETag seen for the same URL, so
+    unchanged resources come back as 304s that don't count against the
+    rate limit and are served from the local copy.
+    """
     headers = kwargs.pop("headers", {})
     headers.update({
         "Authorization": f"Bearer {GITHUB_TOKEN}",
         "Accept": "application/vnd.github+json",
         "X-GitHub-Api-Version": "2022-11-28",
     })
-    response = requests.request(
-        method, 
-        f"https://api.github.com{endpoint}", 
-        headers=headers, 
-        **kwargs
-    )
+    
+    cache_key = None
+    cached = None
+    if method.upper() == "GET":
+        cache_key = f"{endpoint}?{sorted((kwargs.get('params') or {}).items())}"
+        with github_etag_lock:
+            cached = github_etag_cache.get(cache_key)
+        if cached:
+            headers["If-None-Match"] = cached[0]
+    
+    request_class = github_request_class(method, endpoint)
+    for attempt in range(GITHUB_MAX_RETRIES + 1):
+        if hasattr(kwargs.get("data"), "seek"):
+            kwargs["data"].seek(0)  # streamed bodies are rewound for a retry
+        with github_slot(request_class), \
+                span("external", service="github", endpoint=f"{method.upper()} {github_endpoint_label(endpoint)}") as s:
+            response = http_request(
+                method, 
+                f"{GITHUB_API_URL}{endpoint}", 
+                headers=headers, 
+                **kwargs
+            )
+            s["status"] = response.status_code
+        github_observe_limits(response)
+        if not github_rate_limited(response) or attempt == GITHUB_MAX_RETRIES:
+            break
+        
+        delay = github_retry_delay(response, attempt)
+        log.warning(f"GitHub rate limited ({response.status_code}) on {method} {endpoint}, "
+                    f"retrying in {delay:.0f}s ({attempt + 1}/{GITHUB_MAX_RETRIES})")
+        with github_limits_cond:
+            # github_wait_turn holds this call and every other one until the pause ends
+            github_limits["paused_until"] = max(github_limits["paused_until"], time.time() + delay)
+    RETRIES.labels("github").observe(attempt)
+    
+    if response.status_code == 304 and cached:
+        with github_etag_lock:
+            github_etag_cache.move_to_end(cache_key)
+        return cached[1]
     if response.status_code not in [200, 201, 204]:
-        print(f"GitHub API error: {response.status_code}, {response.text}")
-        raise Exception(f"GitHub API error: {response.status_code}, {response.text}")
-    return response.json() if response.content else {}
+        log.error(f"GitHub API error: {response.status_code}, {response.text}")
+        raise GitHubAPIError(response.status_code, response.text)
+    
+    body = response.json() if response.content else {}
+    etag = response.headers.get("ETag")
+    if cache_key and etag:
+        with github_etag_lock:
+            github_etag_cache[cache_key] = (etag, body)
+            github_etag_cache.move_to_end(cache_key)
+            while len(github_etag_cache) > GITHUB_ETAG_CACHE_SIZE:
+                github_etag_cache.popitem(last=False)
+    return body
+
+
+# route name -> request/error counters and recent latency samples
+llm_route_stats: dict[str, dict] = {}
+llm_route_stats_lock = threading.RLock()
+
+# key -> (created_at, completion text), least recently used first
+llm_cache: OrderedDict[str, tuple[float, str]] = OrderedDict()
+llm_cache_lock = threading.Lock()
+llm_cache_stats = {"memory_hits": 0, "disk_hits": 0, "shared_hits": 0, "misses": 0, "coalesced": 0}
+# key -> Future of the upstream call currently running for that key
+llm_inflight: dict[str, Future] = {}
+
+
+def llm_cache_path(key: str) -> str:
+    return os.path.join(LLM_CACHE_DIR, f"{key}.json")
+
+
+def llm_cache_read_disk(key: str) -> tuple[float, str] | None:
+    """Return a fresh disk entry for key, or None if missing or expired."""
+    path = llm_cache_path(key)
+    try:
+        with open(path, encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - entry["created_at"] > LLM_CACHE_TTL:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+    try:
+        os.utime(path)  # mtime doubles as last-access time for eviction
+    except OSError:
+        pass
+    return entry["created_at"], entry["text"]
+
+
+def llm_cache_write_disk(key: str, created_at: float, text: str):
+    """Store an entry on disk, then evict expired and least recently used files."""
+    os.makedirs(LLM_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{llm_cache_path(key)}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"created_at": created_at, "text": text}, f)
+    os.replace(tmp_path, llm_cache_path(key))
+    
+    entries = []
+    with os.scandir(LLM_CACHE_DIR) as it:
+        for entry in it:
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    now = time.time()
+    for mtime, size, path in entries:
+        if total <= LLM_CACHE_DISK_BYTES and now - mtime <= LLM_CACHE_TTL:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+
+def llm_cache_read_shared(key: str) -> tuple[float, str] | None:
+    """Return an entry another host cached, or None; hosts' disks aren't shared."""
+    if coordination is None or not coordination.spans_hosts:
+        return None
+    try:
+        entry = coordination.cache_get(f"llm:{key}")
+    except Exception as e:
+        log.warning(f"⚠️ Shared LLM cache read error: {e}")
+        return None
+    if entry is None:
+        return None
+    entry = json.loads(entry)
+    return entry["created_at"], entry["text"]
+
+
+def llm_cache_write_shared(key: str, created_at: float, text: str):
+    if coordination is None or not coordination.spans_hosts:
+        return
+    try:
+        coordination.cache_set(f"llm:{key}", json.dumps({"created_at": created_at, "text": text}), LLM_CACHE_TTL)
+    except Exception as e:
+        log.warning(f"⚠️ Shared LLM cache write error: {e}")
+
+
+def llm_cache_put_memory(key: str, created_at: float, text: str):
+    with llm_cache_lock:
+        llm_cache[key] = (created_at, text)
+        llm_cache.move_to_end(key)
+        while len(llm_cache) > LLM_CACHE_MEMORY_ITEMS:
+            llm_cache.popitem(last=False)
+
+
+def cached_completion(payload: dict, fetch) -> str:
+    """Return the completion for payload, calling fetch() only on a cache miss.
+
+    Entries are keyed by a hash of the request payload (model, messages,
+    max_tokens) and checked in memory, then on disk, then in the
+    coordination cache when that is shared between hosts. Concurrent
+    callers in this process with the same payload share one upstream call.
+    """
+    key = hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+    
+    with llm_cache_lock:
+        cached = llm_cache.get(key)
+        if cached and time.time() - cached[0] <= LLM_CACHE_TTL:
+            llm_cache.move_to_end(key)
+            llm_cache_stats["memory_hits"] += 1
+            LLM_CACHE_EVENTS.labels("memory_hits").inc()
+            return cached[1]
+    
+    cached = llm_cache_read_disk(key)
+    if cached:
+        llm_cache_put_memory(key, *cached)
+        with llm_cache_lock:
+            llm_cache_stats["disk_hits"] += 1
+            LLM_CACHE_EVENTS.labels("disk_hits").inc()
+        return cached[1]
+    
+    cached = llm_cache_read_shared(key)
+    if cached:
+        llm_cache_put_memory(key, *cached)
+        with llm_cache_lock:
+            llm_cache_stats["shared_hits"] += 1
+            LLM_CACHE_EVENTS.labels("shared_hits").inc()
+        return cached[1]
+    
+    with llm_cache_lock:
+        future = llm_inflight.get(key)
+        owner = future is None
+        if owner:
+            future = llm_inflight[key] = Future()
+            llm_cache_stats["misses"] += 1
+            LLM_CACHE_EVENTS.labels("misses").inc()
+        else:
+            llm_cache_stats["coalesced"] += 1
+            LLM_CACHE_EVENTS.labels("coalesced").inc()
+    if not owner:
+        return future.result()
+    
+    try:
+        text = fetch()
+        future.set_result(text)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with llm_cache_lock:
+            llm_inflight.pop(key, None)
+    
+    # Empty completions are failures in disguise, don't pin them
+    if text:
+        created_at = time.time()
+        llm_cache_put_memory(key, created_at, text)
+        try:
+            llm_cache_write_disk(key, created_at, text)
+        except OSError as e:
+            log.error(f"LLM cache write error: {e}")
+        llm_cache_write_shared(key, created_at, text)
+    return text
+
+
+class FenceExtractor:
+    """Incrementally pull the code block a completion is wrapped in.
+
+    The wrapper is the first ```html / ```markdown / ```md fence, or a bare
+    ``` if it is the first fence in the text. Fences opened inside it (a
+    ```bash block in a README) are tracked so their closing ``` doesn't end
+    the wrapper early. Text with no wrapper is returned as a whole.
+    """
+
+    WRAPPER_LANGS = ("html", "markdown", "md")
+
+    def __init__(self):
+        self.text = ""
+        self.scanned = 0  # offset of the first line not yet scanned
+        self.seen_fence = False
+        self.start = None  # offset of the wrapper's first code line
+        self.end = None  # offset of the wrapper's closing fence
+        self.depth = 0
+
+    @property
+    def done(self) -> bool:
+        return self.end is not None
+
+    def feed(self, chunk: str) -> bool:
+        """Add streamed text; returns True once the wrapper has closed."""
+        self.text += chunk
+        while not self.done:
+            newline = self.text.find("\n", self.scanned)
+            if newline == -1:
+                break
+            self.scan_line(self.text[self.scanned:newline], self.scanned)
+            self.scanned = newline + 1
+        return self.done
 
+    def scan_line(self, line: str, offset: int):
+        stripped = line.strip()
+        if not stripped.startswith("```"):
+            return
+        lang = stripped[3:].strip().lower()
+        if self.start is None:
+            if lang in self.WRAPPER_LANGS or (not lang and not self.seen_fence):
+                self.start = offset + len(line) + 1
+                self.depth = 1
+            self.seen_fence = True
+        elif lang:
+            self.depth += 1
+        else:
+            self.depth -= 1
+            if self.depth == 0:
+                self.end = offset
+
+    def code(self) -> str:
+        """The wrapped code, or everything received if there is no wrapper."""
+        if not self.done and self.scanned < len(self.text):
+            # The last line has no newline yet but may be the closing fence
+            self.scan_line(self.text[self.scanned:], self.scanned)
+            self.scanned = len(self.text)
+        if self.start is None:
+            return self.text.strip()
+        return self.text[self.start:self.end].strip()
+
+
+def report_llm_progress(label: str, chars: int, done: bool = False):
+    """Expose how much of a completion has arrived on the current job."""
+    job = current_job.get()
+    if job is not None:
+        job.setdefault("llm_progress", {})[label] = {"chars": chars, "done": done}
+
+
+class LLMAPIError(Exception):
+    """Raised when an LLM endpoint returns a non-success status code."""
+
+    def __init__(self, route: str, status_code: int, text: str):
+        super().__init__(f"LLM error from {route}: {status_code}, {text}")
+        self.status_code = status_code
+
+
+class LLMCancelled(Exception):
+    """Raised inside a hedged attempt that lost the race."""
+
+
+def llm_retryable(error: Exception) -> bool:
+    """Whether another route should be tried after this error."""
+    if isinstance(error, LLMAPIError):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, (requests.RequestException, LLMCancelled)) or "stream error" in str(error)
+
+
+def route_stats(route: dict) -> dict:
+    with llm_route_stats_lock:
+        return llm_route_stats.setdefault(route["name"], {
+            "requests": 0, "errors": 0, "wins": 0, "hedges": 0, "cancelled": 0,
+            "first_token": deque(maxlen=LLM_LATENCY_SAMPLES),
+            "latency": deque(maxlen=LLM_LATENCY_SAMPLES),
+        })
+
+
+def percentile(samples, p: float) -> float | None:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
 
-def llm_generate(prompt: str) -> str:
-    """Call AIPIPE API to generate content."""
-    response = requests.post(
-        "https://aipipe.org/openrouter/v1/chat/completions",
+
+def hedge_delay(route: dict) -> float:
+    """Seconds to wait for a first token from route before sending a hedge.
+
+    Tracks the route's observed p95 time to first token once there are
+    enough samples, clamped to [LLM_HEDGE_MIN_DELAY, LLM_HEDGE_MAX_DELAY].
+    """
+    stats = route_stats(route)
+    with llm_route_stats_lock:
+        samples = list(stats["first_token"])
+    if len(samples) < 10:
+        return LLM_HEDGE_INITIAL_DELAY
+    return min(max(percentile(samples, 95), LLM_HEDGE_MIN_DELAY), LLM_HEDGE_MAX_DELAY)
+
+
+def llm_stats_summary() -> dict:
+    """Per-route request, error and latency figures for GET /."""
+    with llm_route_stats_lock:
+        return {
+            name: {
+                **{k: v for k, v in stats.items() if not isinstance(v, deque)},
+                "first_token_p50": percentile(stats["first_token"], 50),
+                "first_token_p95": percentile(stats["first_token"], 95),
+                "latency_p50": percentile(stats["latency"], 50),
+                "latency_p95": percentile(stats["latency"], 95),
+            }
+            for name, stats in llm_route_stats.items()
+        }
+
+
+def route_request(route: dict, payload: dict, attempt: dict, stream: bool) -> requests.Response:
+    """Send payload to a route, keeping the response on the attempt so it can be cancelled."""
+    response = http_request(
+        "POST",
+        route["url"],
         headers={
-            "Authorization": f"Bearer {AIPIPE_API_KEY}",
+            "Authorization": f"Bearer {os.getenv(route.get('api_key_env', 'AIPIPE_API_KEY'))}",
             "Content-Type": "application/json",
+            **({"Accept": "text/event-stream"} if stream else {}),
         },
-        json={
-            "model": "openai/gpt-4o-mini",
-            "messages": [{"role": "user", "content": prompt}],
-            "max_tokens": 4096,
-        },
-        timeout=120,
+        json={**payload, "model": route["model"], **({"stream": True} if stream else {})},
+        stream=stream,
+        timeout=route.get("timeout", 120),
     )
+    attempt["response"] = response
+    if attempt["cancel"].is_set():
+        response.close()
+        raise LLMCancelled()
     if response.status_code != 200:
-        print(f"AIPIPE error: {response.status_code}, {response.text}")
-        raise Exception(f"AIPIPE error: {response.status_code}, {response.text}")
-    
-    content = response.json().get("content", [{}])[0].get("text", "")
-    # Strip markdown code blocks if present
-    for lang in ["html", "markdown", ""]:
-        marker = f"```{lang}"
-        if marker in content:
-            content = content.split(marker)[1].split("```")[0].strip()
-            break
-    return content
+        log.error(f"LLM error from {route['name']}: {response.status_code}, {response.text}")
+        raise LLMAPIError(route["name"], response.status_code, response.text)
+    return response
+
+
+def stream_completion(route: dict, payload: dict, label: str, attempt: dict, stop_at_fence: bool = True) -> str:
+    """Stream a chat completion and stop as soon as its code block closes.
+
+    Returns the raw text received. Closing the response early stops the
+    upstream generation, so tokens after the closing fence aren't paid for.
+    """
+    response = route_request(route, payload, attempt, stream=True)
+    try:
+        response.encoding = "utf-8"
+        extractor = FenceExtractor()
+        finish_reason = None
+        for line in response.iter_lines(decode_unicode=True):
+            if attempt["cancel"].is_set():
+                raise LLMCancelled()
+            # Blank lines separate events and ":" lines are keep-alive comments
+            if not line or not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            chunk = json.loads(data)
+            if "error" in chunk:
+                raise Exception(f"LLM stream error from {route['name']}: {chunk['error']}")
+            attempt["usage"] = chunk.get("usage") or attempt.get("usage")
+            choice = (chunk.get("choices") or [{}])[0]
+            finish_reason = choice.get("finish_reason") or finish_reason
+            delta = choice.get("delta", {}).get("content") or ""
+            if delta and not attempt["first_token"].is_set():
+                attempt["first_token"].set()
+                attempt["first_token_at"] = time.monotonic()
+            if extractor.feed(delta) and stop_at_fence:
+                log.info(f"Code block for {label} complete after {len(extractor.text)} chars, closing stream")
+                break
+            report_llm_progress(label, len(extractor.text))
+        
+        if finish_reason == "length" and not extractor.done:
+            log.warning(f"⚠️ Completion for {label} hit max_tokens before its code block closed")
+        report_llm_progress(label, len(extractor.text), done=True)
+        return extractor.text
+    finally:
+        response.close()
+
 
+def observe_llm_tokens(route: dict, payload: dict, text: str, usage: dict | None):
+    """Record token counts from the reply's usage, or estimate them at ~4 chars per token."""
+    usage = usage or {}
+    prompt_chars = sum(len(m["content"]) for m in payload["messages"])
+    LLM_TOKENS.labels(route["name"], "prompt").observe(usage.get("prompt_tokens") or prompt_chars // 4)
+    LLM_TOKENS.labels(route["name"], "completion").observe(usage.get("completion_tokens") or len(text) // 4)
 
-def create_repo_with_pages(repo_name: str, files: list[dict]):
-    """Create repo, enable pages, and push files."""
-    print(f"Creating repository: {repo_name}")
+
+def run_llm_attempt(route: dict, payload: dict, label: str, attempt: dict, stop_at_fence: bool, results: queue.Queue):
+    """Run one completion attempt on a route and post its outcome to results."""
+    stats = route_stats(route)
+    with llm_route_stats_lock:
+        stats["requests"] += 1
+    try:
+        with span("external", service="llm", endpoint=route["name"], label=label) as s:
+            try:
+                if LLM_STREAM:
+                    text = stream_completion(route, payload, label, attempt, stop_at_fence)
+                else:
+                    response = route_request(route, payload, attempt, stream=False)
+                    reply = response.json()
+                    text = reply["choices"][0]["message"]["content"] or ""
+                    attempt["usage"] = reply.get("usage")
+                    attempt["first_token"].set()
+                    attempt["first_token_at"] = time.monotonic()
+            except Exception:
+                if attempt["cancel"].is_set():
+                    s["status"] = "cancelled"
+                raise
+    except Exception as e:
+        if attempt["cancel"].is_set():
+            e = LLMCancelled()
+        with llm_route_stats_lock:
+            stats["cancelled" if isinstance(e, LLMCancelled) else "errors"] += 1
+        results.put((attempt, None, e))
+        return
     
-    # Create repo
-    github_request("POST", "/user/repos", json={
-        "name": repo_name,
-        "private": False,
-        "auto_init": True,
-        "license_template": "mit",
-    })
+    observe_llm_tokens(route, payload, text, attempt.get("usage"))
+    with llm_route_stats_lock:
+        stats["first_token"].append(attempt.get("first_token_at", time.monotonic()) - attempt["started"])
+        stats["latency"].append(time.monotonic() - attempt["started"])
+    results.put((attempt, text, None))
+
+
+def routed_completion(payload: dict, label: str, stop_at_fence: bool = True) -> str:
+    """Get a completion from the configured routes, hedging and failing over.
+
+    The first route is tried first. If it hasn't produced a first token
+    within hedge_delay(), the same request is sent to the next route and
+    whichever finishes first wins; the other is cancelled. A 429, 5xx or
+    connection error moves on to the next untried route. The hedge timer
+    follows the newest attempt still running, and a route that already
+    failed in this call is never hedged onto again.
+    """
+    untried = list(LLM_ROUTES)
+    results: queue.Queue = queue.Queue()
+    attempts = []
+    errors = []
+    failed_routes = set()
+    
+    def launch(route: dict):
+        attempt = {
+            "route": route, "cancel": threading.Event(), "first_token": threading.Event(),
+            "response": None, "started": time.monotonic(),
+        }
+        attempts.append(attempt)
+        ctx = contextvars.copy_context()
+        threading.Thread(
+            target=ctx.run, args=(run_llm_attempt, route, payload, label, attempt, stop_at_fence, results),
+            daemon=True,
+        ).start()
+    
+    launch(untried.pop(0))
+    hedged = False
+    pending = 1
+    while pending:
+        primary = next(a for a in reversed(attempts) if not a.get("done"))
+        wait_for = None
+        if LLM_HEDGE and not hedged:
+            wait_for = max(0, hedge_delay(primary["route"]) - (time.monotonic() - primary["started"]))
+        try:
+            attempt, text, error = results.get(timeout=wait_for)
+        except queue.Empty:
+            hedged = True
+            if not primary["first_token"].is_set():
+                # Hedge on the next route, or the same one again if it is the only one left and hasn't failed
+                route = untried.pop(0) if untried else primary["route"]
+                if route["name"] in failed_routes:
+                    continue
+                log.warning(f"No first token from {primary['route']['name']} for {label} yet, hedging on {route['name']}")
+                with llm_route_stats_lock:
+                    route_stats(route)["hedges"] += 1
+                launch(route)
+                pending += 1
+            continue
+        
+        pending -= 1
+        attempt["done"] = True
+        if error is None:
+            for other in attempts:
+                if other is not attempt:
+                    other["cancel"].set()
+                    if other["response"] is not None:
+                        other["response"].close()
+            with llm_route_stats_lock:
+                route_stats(attempt["route"])["wins"] += 1
+            RETRIES.labels("llm").observe(len(attempts) - 1)
+            return text
+        
+        errors.append(error)
+        if not isinstance(error, LLMCancelled):
+            failed_routes.add(attempt["route"]["name"])
+        if not llm_retryable(error) and not pending:
+            RETRIES.labels("llm").observe(len(attempts) - 1)
+            raise error
+        if llm_retryable(error) and untried and not pending:
+            route = untried.pop(0)
+            log.warning(f"LLM route {attempt['route']['name']} failed ({error}), failing over to {route['name']}")
+            launch(route)
+            pending += 1
+    
+    RETRIES.labels("llm").observe(len(attempts) - 1)
+    raise Exception(f"All LLM routes failed for {label}: {'; '.join(str(e) for e in errors)}")
+
+
+def llm_generate(prompt: str, label: str = "completion", raw: bool = False) -> str:
+    """Generate content through the LLM routes and return the code it is wrapped in.
+
+    With raw=True the whole reply is returned, for replies that aren't a
+    single code block.
+    """
+    payload = {
+        "model": LLM_MODEL,
+        "messages": [{"role": "user", "content": prompt}],
+        "max_tokens": LLM_MAX_TOKENS,
+    }
+    
+    content = cached_completion(payload, lambda: routed_completion(payload, label, stop_at_fence=not raw))
+    if raw:
+        return content
+    extractor = FenceExtractor()
+    extractor.feed(content)
+    return extractor.code()
+
+
+def data_uri_chunks(uri: str):
+    """Split a data: URI into its MIME type and an iterator of decoded chunks."""
+    header, _, payload = uri.partition(",")
+    params = header[len("data:"):].split(";")
+    mime = params[0] or "text/plain"
+    if "base64" not in params[1:]:
+        return mime, iter([unquote_to_bytes(payload)])
     
-    # Enable GitHub Pages
-    print("Enabling GitHub Pages...")
-    time.sleep(3)  # Wait for repo initialization
+    def chunks():
+        # 4 base64 characters decode to 3 bytes, so 4-aligned slices decode independently
+        step = ATTACHMENT_CHUNK_BYTES // 3 * 4
+        for i in range(0, len(payload), step):
+            yield base64.b64decode(payload[i:i + step])
+    return mime, chunks()
+
+
+def url_chunks(url: str):
+    """Download an http(s) attachment as a stream; returns its MIME type and chunks."""
+    with span("external", service="attachments", endpoint=urlsplit(url).netloc) as s:
+        response = http_request("GET", url, stream=True, timeout=30)
+        s["status"] = response.status_code
+    if response.status_code != 200:
+        response.close()
+        raise Exception(f"Attachment download failed: {response.status_code} for {url}")
+    mime = response.headers.get("Content-Type", "").split(";")[0].strip()
     
+    def chunks():
+        try:
+            yield from response.iter_content(ATTACHMENT_CHUNK_BYTES)
+        finally:
+            response.close()
+    return mime, chunks()
+
+
+def store_attachment(chunks) -> tuple[str, int, str]:
+    """Write chunks into the attachment store, keyed by their SHA-256.
+
+    Identical files from any task share one copy on disk. Raises ValueError
+    once the content passes ATTACHMENT_MAX_BYTES. Returns (sha256, size, path).
+    """
+    os.makedirs(ATTACHMENT_STORE_DIR, exist_ok=True)
+    tmp_path = os.path.join(ATTACHMENT_STORE_DIR, f"{uuid.uuid4().hex}.tmp")
+    digest = hashlib.sha256()
+    size = 0
     try:
-        github_request("POST", f"/repos/{GITHUB_USERNAME}/{repo_name}/pages", json={
-            "build_type": "legacy",
-            "source": {"branch": "main", "path": "/"}
+        with open(tmp_path, "wb") as f:
+            for chunk in chunks:
+                size += len(chunk)
+                if size > ATTACHMENT_MAX_BYTES:
+                    raise ValueError(f"larger than {ATTACHMENT_MAX_BYTES} bytes")
+                digest.update(chunk)
+                f.write(chunk)
+        path = os.path.join(ATTACHMENT_STORE_DIR, digest.hexdigest())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return digest.hexdigest(), size, path
+
+
+def attachment_repo_path(name: str, taken: set[str]) -> str:
+    """Pick where an attachment lives in the repo, next to index.html if possible."""
+    name = os.path.basename(name.replace("\\", "/")) or "attachment"
+    path = name if name not in taken else f"attachments/{name}"
+    stem, ext = os.path.splitext(name)
+    n = 1
+    while path in taken:
+        path = f"attachments/{stem}-{n}{ext}"
+        n += 1
+    taken.add(path)
+    return path
+
+
+def store_request_attachments(attachments: list[dict]) -> list[dict]:
+    """Decode a request's data: attachments into the store as it is submitted.
+
+    Each becomes a {name, sha256, mime, size} reference, so the queue and
+    the ledger never hold the base64 payload; http(s) attachments are kept
+    as they are. Raises ValueError naming the attachment that is malformed
+    or over ATTACHMENT_MAX_BYTES.
+    """
+    if not isinstance(attachments, list) or not all(isinstance(a, dict) for a in attachments):
+        raise ValueError("Attachments must be a list of {name, url} objects")
+    stored = []
+    for attachment in attachments:
+        name, url = attachment.get("name") or "attachment", str(attachment.get("url", ""))
+        if not url.startswith("data:"):
+            stored.append(attachment)
+            continue
+        try:
+            mime, chunks = data_uri_chunks(url)
+            sha256, size, _ = store_attachment(chunks)
+        except Exception as e:
+            raise ValueError(f"Attachment {name} rejected: {e}") from None
+        stored.append({"name": name, "sha256": sha256, "mime": mime, "size": size})
+    return stored
+
+
+def fetch_attachments(attachments: list[dict]) -> list[dict]:
+    """Download every attachment into the local store, or find it there.
+
+    Returns a manifest entry per attachment (name, repo path, MIME type,
+    size, SHA-256 and local path). Attachments that can't be fetched or are
+    over the size cap are skipped with a warning rather than failing the task.
+    """
+    manifest = []
+    taken = {"index.html", "README.md", "LICENSE"}
+    for attachment in attachments:
+        name, url = attachment.get("name") or "attachment", attachment.get("url", "")
+        try:
+            if not url and "sha256" in attachment:
+                # Decoded by store_request_attachments when the task was submitted
+                sha256, mime = str(attachment["sha256"]), attachment.get("mime")
+                local_path = os.path.join(ATTACHMENT_STORE_DIR, sha256)
+                if not re.fullmatch(r"[0-9a-f]{64}", sha256) or not os.path.exists(local_path):
+                    raise ValueError(f"{sha256[:12]} is not in the attachment store")
+                size = os.path.getsize(local_path)
+            else:
+                if url.startswith("data:"):
+                    mime, chunks = data_uri_chunks(url)
+                elif url.startswith(("http://", "https://")):
+                    mime, chunks = url_chunks(url)
+                else:
+                    raise ValueError("unsupported URL scheme")
+                sha256, size, local_path = store_attachment(chunks)
+        except Exception as e:
+            log.error(f"❌ Skipping attachment {name}: {e}")
+            continue
+        
+        manifest.append({
+            "name": name,
+            "path": attachment_repo_path(name, taken),
+            "mime": mime or mimetypes.guess_type(name)[0] or "application/octet-stream",
+            "size": size,
+            "sha256": sha256,
+            "local_path": local_path,
         })
-    except Exception as e:
-        print(f"Pages enable error (may already exist): {e}")
+        log.info(f"Stored attachment {name} ({size} bytes, {sha256[:12]})")
+    return manifest
+
+
+def attachments_prompt(manifest: list[dict]) -> str:
+    """Describe committed attachments for a prompt without their contents."""
+    if not manifest:
+        return "None"
+    return "\n".join(
+        f"- {a['name']} ({a['mime']}, {a['size']} bytes), committed at ./{a['path']}"
+        for a in manifest
+    )
+
+
+def attachment_files(manifest: list[dict]) -> list[dict]:
+    """Turn a manifest into push_files entries that upload from the store."""
+    return [{"name": a["path"], "local_path": a["local_path"]} for a in manifest]
+
+
+class Base64FileBody:
+    """A file's bytes as a Git blob JSON request body, base64 encoded on the fly.
+
+    requests streams it with a Content-Length, so a large attachment is
+    never held in memory as raw bytes, base64 text and JSON at once.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        size = os.path.getsize(path)
+        self.prefix = b'{"encoding": "base64", "content": "'
+        self.suffix = b'"}'
+        self.length = len(self.prefix) + 4 * -(-size // 3) + len(self.suffix)
+        self.seek(0)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __iter__(self):
+        while chunk := self.read(ATTACHMENT_CHUNK_BYTES):
+            yield chunk
+
+    def seek(self, offset: int, whence: int = 0):
+        """Rewind for a retry; only seek(0) is supported."""
+        self.pending = self.prefix
+        self.file_offset = 0
+        self.suffix_sent = False
+
+    def read(self, size: int = -1) -> bytes:
+        size = ATTACHMENT_CHUNK_BYTES if size is None or size < 0 else size
+        while len(self.pending) < size and not self.suffix_sent:
+            with open(self.path, "rb") as f:
+                f.seek(self.file_offset)
+                raw = f.read(ATTACHMENT_CHUNK_BYTES)
+            if raw:
+                self.file_offset += len(raw)
+                self.pending += base64.b64encode(raw)
+            else:
+                self.pending += self.suffix
+                self.suffix_sent = True
+        chunk, self.pending = self.pending[:size], self.pending[size:]
+        return chunk
+
+
+def git_blob_sha(file: dict) -> str:
+    """The Git object SHA a push_files entry will have, computed locally."""
+    if "local_path" in file:
+        digest = hashlib.sha1(f"blob {os.path.getsize(file['local_path'])}\0".encode())
+        with open(file["local_path"], "rb") as f:
+            while chunk := f.read(ATTACHMENT_CHUNK_BYTES):
+                digest.update(chunk)
+        return digest.hexdigest()
+    content = file["content"]
+    return hashlib.sha1(f"blob {len(content)}\0".encode() + content).hexdigest()
+
+
+# (repo, blob SHA) pairs already uploaded by this process
+uploaded_blobs: set[tuple[str, str]] = set()
+uploaded_blobs_lock = threading.Lock()
+
+
+def create_blob(repo_name: str, file: dict) -> str:
+    """Upload a bytes or local_path entry as a Git blob and return its SHA."""
+    if "local_path" in file:
+        blob = github_request(
+            "POST", f"/repos/{GITHUB_USERNAME}/{repo_name}/git/blobs",
+            data=Base64FileBody(file["local_path"]),
+            headers={"Content-Type": "application/json"},
+        )
+    else:
+        blob = github_request("POST", f"/repos/{GITHUB_USERNAME}/{repo_name}/git/blobs", json={
+            "content": base64.b64encode(file["content"]).decode("utf-8"),
+            "encoding": "base64",
+        })
+    with uploaded_blobs_lock:
+        uploaded_blobs.add((repo_name, blob["sha"]))
+    return blob["sha"]
+
+
+def push_files(repo_name: str, files: list[dict], message: str, retries: int = 3) -> str:
+    """Push all files to main as a single commit using the Git Data API.
+
+    Text files are inlined into the tree. Binary files (bytes `content`,
+    or a `local_path` streamed from disk) are uploaded as blobs in parallel,
+    once per distinct content and only if this process hasn't already
+    uploaded them to the repo. One deploy costs one tree, one commit and one
+    ref update no matter how many files it contains. If main moves
+    underneath us the commit is rebuilt on the new head. Returns the new
+    commit SHA.
+    """
+    repo_path = f"/repos/{GITHUB_USERNAME}/{repo_name}"
     
-    # Push files
-    print("Pushing files...")
-    for file in files:
-        content = file["content"]
-        path = file["name"]
-        
-        # Base64 encode the content
-        if isinstance(content, bytes):
-            encoded = base64.b64encode(content).decode("utf-8")
-        else:
-            encoded = base64.b64encode(str(content).encode("utf-8")).decode("utf-8")
+    binary_files = [f for f in files if "local_path" in f or isinstance(f.get("content"), bytes)]
+    blob_shas = [git_blob_sha(f) for f in binary_files]
+    with uploaded_blobs_lock:
+        to_upload = {sha: f for f, sha in zip(binary_files, blob_shas) if (repo_name, sha) not in uploaded_blobs}
+    with ThreadPoolExecutor(max_workers=BLOB_UPLOAD_WORKERS) as pool:
+        list(pool.map(lambda f: create_blob(repo_name, f), to_upload.values()))
+    
+    tree = [
+        {"path": f["name"], "mode": "100644", "type": "blob", "sha": sha}
+        for f, sha in zip(binary_files, blob_shas)
+    ]
+    tree += [
+        {"path": f["name"], "mode": "100644", "type": "blob", "content": str(f["content"])}
+        for f in files if f not in binary_files
+    ]
+    
+    for attempt in range(1, retries + 1):
+        head_sha = github_request("GET", f"{repo_path}/git/ref/heads/main")["object"]["sha"]
+        head_commit = github_request("GET", f"{repo_path}/git/commits/{head_sha}")
         
-        # --- START: MODIFIED LOGIC ---
+        new_tree = github_request("POST", f"{repo_path}/git/trees", json={
+            "base_tree": head_commit["tree"]["sha"],
+            "tree": tree,
+        })
+        commit = github_request("POST", f"{repo_path}/git/commits", json={
+            "message": message,
+            "tree": new_tree["sha"],
+            "parents": [head_sha],
+        })
         
-        # 1. Check if the file already exists to get its SHA
-        current_sha = None
         try:
-            file_data = github_request("GET", f"/repos/{GITHUB_USERNAME}/{repo_name}/contents/{path}")
-            current_sha = file_data.get("sha")
-        except Exception:
-            # If it throws an error (like 404), the file doesn't exist. That's fine.
-            print(f"File '{path}' not found. Creating it.")
-
-        # 2. Build the payload, including the SHA if it exists
-        payload = {
-            "message": f"Add or update {path}",
-            "content": encoded,
-        }
-        if current_sha:
-            payload["sha"] = current_sha
-
-        # 3. Make the request to create or update the file
-        github_request("PUT", f"/repos/{GITHUB_USERNAME}/{repo_name}/contents/{path}", json=payload)
+            github_request("PATCH", f"{repo_path}/git/refs/heads/main", json={"sha": commit["sha"]})
+        except GitHubAPIError as e:
+            # 422 means main is no longer at head_sha (not a fast-forward)
+            if e.status_code != 422 or attempt == retries:
+                raise
+            log.warning(f"main moved during push, retrying ({attempt}/{retries})")
+            continue
         
-        # --- END: MODIFIED LOGIC ---
+        log.info(f"Pushed {len(files)} files in commit {commit['sha'][:7]}: {', '.join(f['name'] for f in files)}")
+        return commit["sha"]
+
+
+def run_graph(steps: dict[str, tuple], timeout: float | None = None) -> dict:
+    """Run a small dependency graph of blocking steps, independent ones in parallel.
+
+    `steps` maps a name to `(func, deps)`; each func is called with the
+    results of its deps as keyword arguments once they are all done.
+    Returns every step's result by name. Raises TimeoutError if the whole
+    graph has not finished within `timeout` seconds.
+    """
+    results = {}
+    pending = dict(steps)
+    running = {}
+    deadline = time.monotonic() + timeout if timeout else None
+    pool = ThreadPoolExecutor(max_workers=len(steps))
+    try:
+        while pending or running:
+            for name, (func, deps) in list(pending.items()):
+                if all(d in results for d in deps):
+                    # Each step gets its own copy of the context so current_job follows it
+                    ctx = contextvars.copy_context()
+                    running[pool.submit(ctx.run, func, **{d: results[d] for d in deps})] = name
+                    del pending[name]
+            if not running:
+                raise ValueError(f"Unresolvable dependencies for steps: {', '.join(pending)}")
+            
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            done, _ = wait(running, timeout=remaining, return_when=FIRST_COMPLETED)
+            if not done:
+                raise TimeoutError(f"Steps still running after {timeout}s: {', '.join(running.values())}")
+            for future in done:
+                results[running.pop(future)] = future.result()
+    finally:
+        # Don't block on steps left behind by a failure or timeout
+        pool.shutdown(wait=False, cancel_futures=True)
+    return results
+
+
+def wait_until(check, timeout: float, what: str, initial_delay: float = 0.5, max_delay: float = 8.0):
+    """Poll check() until it returns a truthy value or the deadline passes.
+
+    Delays grow exponentially with full jitter, capped at max_delay and at
+    the time left. GitHub errors from check() count as "not ready yet".
+    Returns the truthy value, or None if the deadline passed first.
+    """
+    deadline = time.monotonic() + timeout
+    delay = initial_delay
+    while True:
+        try:
+            result = check()
+            if result:
+                return result
+        except GitHubAPIError as e:
+            if e.status_code >= 500 or e.status_code in (401, 403):
+                raise
         
-        print(f"Pushed: {path}")
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            log.warning(f"Timed out after {timeout}s waiting for {what}")
+            return None
+        time.sleep(min(random.uniform(0, delay), remaining))
+        delay = min(delay * 2, max_delay)
 
 
-def update_repo_files(repo_name: str, files: list[dict]):
-    """Update existing files in repo."""
-    print(f"Updating files in repository: {repo_name}")
+def wait_for_repo_ready(repo_name: str) -> bool:
+    """Wait until the new repo's main branch exists."""
+    return bool(wait_until(
+        lambda: github_request("GET", f"/repos/{GITHUB_USERNAME}/{repo_name}/git/ref/heads/main"),
+        REPO_READY_TIMEOUT, f"{repo_name} main branch",
+    ))
+
+
+def wait_for_pages_build(repo_name: str, commit_sha: str) -> dict | None:
+    """Wait until the latest Pages build for the repo is built from commit_sha.
+
+    Returns the build, or None if it errored or didn't finish in time.
+    """
+    def check():
+        build = github_request("GET", f"/repos/{GITHUB_USERNAME}/{repo_name}/pages/builds/latest")
+        if build.get("commit") != commit_sha:
+            return None
+        return build if build.get("status") in ("built", "errored") else None
     
-    for file in files:
-        try:
-            # Get current file SHA
-            file_data = github_request("GET", f"/repos/{GITHUB_USERNAME}/{repo_name}/contents/{file['name']}")
-            
-            content = file["content"]
-            encoded = base64.b64encode(str(content).encode("utf-8")).decode("utf-8")
-            
-            github_request("PUT", f"/repos/{GITHUB_USERNAME}/{repo_name}/contents/{file['name']}", json={
-                "message": f"Update {file['name']}",
-                "content": encoded,
-                "sha": file_data["sha"],
-            })
-            print(f"Updated: {file['name']}")
-        except Exception as e:
-            print(f"Error updating {file['name']}: {e}")
+    build = wait_until(check, PAGES_BUILD_TIMEOUT, f"Pages build of {commit_sha[:7]}")
+    if build and build["status"] == "errored":
+        log.error(f"❌ Pages build of {commit_sha[:7]} failed: {(build.get('error') or {}).get('message')}")
+        return None
+    if build:
+        log.info(f"✅ Pages built {commit_sha[:7]} in {build.get('duration', '?')}ms")
+    return build
+
+
+def create_repo_with_pages(repo_name: str):
+    """Create repo and enable pages."""
+    log.info(f"Creating repository: {repo_name}")
+    
+    # Create repo; a retry of a run cut off after this call finds it already there
+    try:
+        github_request("POST", "/user/repos", json={
+            "name": repo_name,
+            "private": False,
+            "auto_init": True,
+            "license_template": "mit",
+        })
+    except GitHubAPIError as e:
+        if e.status_code != 422 or "already exists" not in e.text:
             raise
+        log.info(f"Repository {repo_name} already exists, continuing with its setup")
+    
+    # Enable GitHub Pages once auto_init has created main
+    wait_for_repo_ready(repo_name)
+    log.info("Enabling GitHub Pages...")
+    
+    try:
+        github_request("POST", f"/repos/{GITHUB_USERNAME}/{repo_name}/pages", json={
+            "build_type": "legacy",
+            "source": {"branch": "main", "path": "/"}
+        })
+    except Exception as e:
+        log.warning(f"Pages enable error (may already exist): {e}")
+
+
+def push_new_app(repo_name: str, files: list[dict]) -> str:
+    """Push the generated files to a freshly created repo."""
+    log.info("Pushing files...")
+    return push_files(repo_name, files, "Add generated application")
+
+
+def update_repo_files(repo_name: str, files: list[dict]) -> str:
+    """Update existing files in repo."""
+    log.info(f"Updating files in repository: {repo_name}")
+    return push_files(repo_name, files, "Update application for round 2")
 
 
 def generate_app_code(brief: str, checks: list[str], attachments: list[dict]) -> list[dict]:
-    """Generate application code using LLM."""
-    print("Generating application code...")
+    """Generate application code using LLM.
+
+    `attachments` is the manifest from fetch_attachments; the prompt only
+    gets each file's name, type, size and repo path.
+    """
+    log.info("Generating application code...")
     
-    attachments_info = "\n".join([f"- {a['name']}: {a['url'][:100]}..." for a in attachments]) if attachments else "None"
+    attachments_info = attachments_prompt(attachments)
     
-    html_code = llm_generate(f"""Create a complete, beautiful single-page HTML application.
+    html_prompt = f"""Create a complete, beautiful single-page HTML application.
 
 Brief: {brief}
 
 Requirements (must satisfy these checks):
 {chr(10).join(f"- {c}" for c in checks)}
 
-Attachments: {attachments_info}
+Attachments (committed to the repo; load them by the relative path given):
+{attachments_info}
 
 Create a fully functional, responsive HTML page with:
 - Tailwind CSS (via CDN: https://cdn.tailwindcss.com)
@@ -205,9 +1518,9 @@ Create a fully functional, responsive HTML page with:
 - Handle query parameters as specified
 - Professional, polished UI
 
-Return ONLY the complete HTML code, no explanations.""")
+Return ONLY the complete HTML code, no explanations."""
     
-    readme = llm_generate(f"""Create a professional README.md for this project.
+    readme_prompt = f"""Create a professional README.md for this project.
 
 Brief: {brief}
 
@@ -219,59 +1532,246 @@ Include:
 5. Code structure explanation
 6. License (MIT)
 
-Keep it concise but professional. Return ONLY the README content.""")
+Keep it concise but professional. Return ONLY the README content."""
+    
+    results = run_graph({
+        "html": (lambda: llm_generate(html_prompt, "index.html"), []),
+        "readme": (lambda: llm_generate(readme_prompt, "README.md"), []),
+    }, timeout=LLM_STAGE_TIMEOUT)
     
     return [
-        {"name": "index.html", "content": html_code},
-        {"name": "README.md", "content": readme},
+        {"name": "index.html", "content": results["html"]},
+        {"name": "README.md", "content": results["readme"]},
     ]
 
 
-def update_app_code(repo_name: str, brief: str, checks: list[str]) -> list[dict]:
-    """Update existing application code based on new requirements."""
-    print("Updating application code...")
-    
-    # Get current files
-    index_data = github_request("GET", f"/repos/{GITHUB_USERNAME}/{repo_name}/contents/index.html")
-    readme_data = github_request("GET", f"/repos/{GITHUB_USERNAME}/{repo_name}/contents/README.md")
+class HTMLOutline(HTMLParser):
+    """Collect a line-numbered outline of an HTML document's structure."""
+
+    VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "track", "wbr"}
+    MAX_DEPTH = 4
+
+    def __init__(self):
+        super().__init__()
+        self.depth = 0
+        self.lines = []
+        self.in_script = False
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if self.depth <= self.MAX_DEPTH or "id" in attrs:
+            label = tag
+            if attrs.get("id"):
+                label += f"#{attrs['id']}"
+            if attrs.get("class"):
+                label += "." + ".".join(attrs["class"].split()[:3])
+            if attrs.get("src"):
+                label += f" src={attrs['src']}"
+            self.lines.append(f"L{self.getpos()[0]} {'  ' * self.depth}<{label}>")
+        self.in_script = tag == "script"
+        if tag not in self.VOID_TAGS:
+            self.depth += 1
+
+    def handle_endtag(self, tag):
+        if tag not in self.VOID_TAGS:
+            self.depth = max(self.depth - 1, 0)
+        self.in_script = False
+
+    def handle_data(self, data):
+        if not self.in_script:
+            return
+        for match in re.finditer(r"(?:function\s+(\w+)|(?:const|let|var)\s+(\w+)\s*=\s*(?:async\s*)?(?:function|\())", data):
+            line = self.getpos()[0] + data[:match.start()].count("\n")
+            self.lines.append(f"L{line} {'  ' * self.depth}fn {match.group(1) or match.group(2)}")
+
+
+def file_outline(name: str, text: str) -> str:
+    """Outline an HTML file's elements and functions, or a markdown file's headings."""
+    if name.endswith(".html"):
+        parser = HTMLOutline()
+        parser.feed(text)
+        return "\n".join(parser.lines)
+    return "\n".join(
+        f"L{i} {line}" for i, line in enumerate(text.splitlines(), 1) if line.startswith("#")
+    )
+
+
+def relevant_sections(text: str, query: str, budget: int) -> str:
+    """Pick the fixed-size line windows of text that best match the query.
+
+    Windows are scored by how many distinct query words they contain; the
+    first window (the document head) is always included. Returns them in
+    file order with their line ranges, within roughly `budget` characters.
+    """
+    lines = text.splitlines()
+    words = {w for w in re.findall(r"[a-z][a-z0-9_-]{3,}", query.lower())}
+    windows = []
+    for start in range(0, len(lines), ROUND2_SECTION_LINES):
+        chunk = "\n".join(lines[start:start + ROUND2_SECTION_LINES])
+        score = sum(1 for w in words if w in chunk.lower())
+        windows.append((start == 0, score, start, chunk))
     
-    current_html = base64.b64decode(index_data["content"]).decode("utf-8")
-    current_readme = base64.b64decode(readme_data["content"]).decode("utf-8")
+    chosen, used = [], 0
+    for _, _, start, chunk in sorted(windows, key=lambda w: (w[0], w[1]), reverse=True):
+        if used + len(chunk) > budget and chosen:
+            continue
+        chosen.append((start, chunk))
+        used += len(chunk)
+    return "\n\n".join(
+        f"Lines {start + 1}-{start + chunk.count(chr(10)) + 1}:\n{chunk}" for start, chunk in sorted(chosen)
+    )
+
+
+EDIT_BLOCK = re.compile(r"<<<<<<< SEARCH\n(.*?)\n?=======\n(.*?)\n?>>>>>>> REPLACE", re.S)
+
+
+def find_loose(text: str, search: str) -> tuple[int, int] | None:
+    """Locate search in text ignoring indentation and trailing whitespace.
+
+    Returns the (start, end) offsets of the single matching run of lines,
+    or None if there is no match or more than one.
+    """
+    needle = [line.strip() for line in search.strip("\n").splitlines()]
+    lines = text.splitlines(keepends=True)
+    stripped = [line.strip() for line in lines]
+    matches = [i for i in range(len(lines) - len(needle) + 1) if stripped[i:i + len(needle)] == needle]
+    if len(matches) != 1 or not needle:
+        return None
+    start = sum(len(line) for line in lines[:matches[0]])
+    end = start + sum(len(line) for line in lines[matches[0]:matches[0] + len(needle)])
+    return start, end - (1 if lines[matches[0] + len(needle) - 1].endswith("\n") else 0)
+
+
+def apply_edits(text: str, edits: list[tuple[str, str]]) -> str:
+    """Apply SEARCH/REPLACE edits in order; raises ValueError if one doesn't apply."""
+    for search, replace in edits:
+        if not search.strip():
+            raise ValueError("empty SEARCH block")
+        count = text.count(search)
+        if count == 1:
+            text = text.replace(search, replace)
+            continue
+        if count > 1:
+            raise ValueError(f"SEARCH block matches {count} times: {search[:60]!r}")
+        located = find_loose(text, search)
+        if located is None:
+            raise ValueError(f"SEARCH block not found: {search[:60]!r}")
+        text = text[:located[0]] + replace + text[located[1]:]
+    return text
+
+
+def validate_update(name: str, original: str, updated: str):
+    """Reject edited files that are empty or visibly broken."""
+    if not updated.strip():
+        raise ValueError("edited file is empty")
+    if name.endswith(".html"):
+        lower = updated.lower()
+        if "</html>" in original.lower() and "</html>" not in lower:
+            raise ValueError("closing </html> tag was lost")
+        if lower.count("<script") != lower.count("</script>"):
+            raise ValueError("unbalanced <script> tags")
+        HTMLParser().feed(updated)
+
+
+def edit_file(name: str, lang: str, current: str, instructions: str) -> str:
+    """Update a file by asking the model for SEARCH/REPLACE edits.
+
+    Small files are sent whole; larger ones as an outline plus the sections
+    most relevant to the instructions. The edits are applied and validated
+    locally, and if that fails the file is regenerated in full.
+    """
+    if len(current) <= ROUND2_FULL_FILE_CHARS:
+        context = f"Current {name}:\n```{lang}\n{current}\n```"
+    else:
+        context = f"""{name} is {len(current.splitlines())} lines long. Outline:
+{file_outline(name, current)}
+
+Relevant sections of the current {name}:
+```{lang}
+{relevant_sections(current, instructions, ROUND2_FULL_FILE_CHARS)}
+```"""
     
-    updated_html = llm_generate(f"""Update this HTML application based on new requirements.
+    reply = llm_generate(f"""{context}
+
+{instructions}
+
+Describe your changes as one or more SEARCH/REPLACE blocks:
+<<<<<<< SEARCH
+exact lines copied from the current {name}
+=======
+the lines that replace them
+>>>>>>> REPLACE
 
-Current Code:
-```html
-{current_html[:2000]}...
+Each SEARCH must match the current file exactly and only once. To add new
+content, search for a nearby anchor line and repeat it in the replacement.
+Return ONLY the blocks, no explanations.""", name, raw=True)
+    
+    edits = EDIT_BLOCK.findall(reply)
+    try:
+        if not edits:
+            raise ValueError("no SEARCH/REPLACE blocks in reply")
+        updated = apply_edits(current, edits)
+        validate_update(name, current, updated)
+        log.info(f"Applied {len(edits)} edits to {name} ({len(current)} -> {len(updated)} chars)")
+        return updated
+    except ValueError as e:
+        log.warning(f"Edit-based update of {name} failed ({e}), regenerating it in full")
+    
+    return llm_generate(f"""Current {name}:
+```{lang}
+{current}
 ```
 
+{instructions}
+
+Return ONLY the complete updated {name}, no explanations.""", name)
+
+
+def update_app_code(repo_name: str, brief: str, checks: list[str], attachments: list[dict]) -> list[dict]:
+    """Update existing application code based on new requirements."""
+    log.info("Updating application code...")
+    
+    def fetch(path: str) -> str:
+        data = github_request("GET", f"/repos/{GITHUB_USERNAME}/{repo_name}/contents/{path}")
+        return base64.b64decode(data["content"]).decode("utf-8")
+    
+    def update_html(current_html: str) -> str:
+        return edit_file("index.html", "html", current_html, f"""Update this HTML application based on new requirements.
+
 New Requirements: {brief}
 
 Checks to satisfy:
 {chr(10).join(f"- {c}" for c in checks)}
 
-Modify the code to meet the new requirements while maintaining quality and design.
-Return ONLY the complete updated HTML code, no explanations.""")
-    
-    updated_readme = llm_generate(f"""Update this README.md for the modified application.
+New attachments (committed to the repo; load them by the relative path given):
+{attachments_prompt(attachments)}
 
-Current README:
-{current_readme}
+Modify the code to meet the new requirements while maintaining quality and design.""")
+    
+    def update_readme(current_readme: str) -> str:
+        return edit_file("README.md", "markdown", current_readme, f"""Update this README.md for the modified application.
 
 New Requirements: {brief}
 
-Update the README to reflect the changes while maintaining professionalism.
-Return ONLY the complete updated README, no explanations.""")
+Update the README to reflect the changes while maintaining professionalism.""")
+    
+    # The HTML and README chains don't depend on each other, so both run at once
+    results = run_graph({
+        "current_html": (lambda: fetch("index.html"), []),
+        "current_readme": (lambda: fetch("README.md"), []),
+        "html": (update_html, ["current_html"]),
+        "readme": (update_readme, ["current_readme"]),
+    }, timeout=LLM_STAGE_TIMEOUT)
     
     return [
-        {"name": "index.html", "content": updated_html},
-        {"name": "README.md", "content": updated_readme},
+        {"name": "index.html", "content": results["html"]},
+        {"name": "README.md", "content": results["readme"]},
     ]
 
 
 def notify_evaluation(data: dict):
     """Send repo details to evaluation URL with retry logic."""
-    print("Notifying evaluation endpoint...")
+    log.info("Notifying evaluation endpoint...")
     
     # Get latest commit SHA
     commit_data = github_request("GET", f"/repos/{GITHUB_USERNAME}/{data['task']}_{data['nonce']}/commits/main")
@@ -286,90 +1786,973 @@ def notify_evaluation(data: dict):
         "pages_url": f"https://{GITHUB_USERNAME}.github.io/{data['task']}_{data['nonce']}/",
     }
     
-    print(f"Payload: {payload}")
+    log.info(f"Payload: {payload}")
     
     for attempt, delay in enumerate([1, 2, 4, 8], 1):
         try:
-            response = requests.post(
-                data["evaluation_url"], 
-                json=payload, 
-                headers={"Content-Type": "application/json"}, 
-                timeout=10
-            )
+            with span("external", service="evaluator", endpoint=urlsplit(data["evaluation_url"]).netloc) as s:
+                response = http_request(
+                    "POST",
+                    data["evaluation_url"], 
+                    json=payload, 
+                    headers={"Content-Type": "application/json"}, 
+                    timeout=10
+                )
+                s["status"] = response.status_code
             if response.status_code == 200:
-                print(f"✅ Notification successful on attempt {attempt}")
+                log.info(f"✅ Notification successful on attempt {attempt}")
+                RETRIES.labels("notify").observe(attempt - 1)
                 return
             else:
-                print(f"Attempt {attempt} failed: {response.status_code}, {response.text}")
+                log.warning(f"Attempt {attempt} failed: {response.status_code}, {response.text}")
         except Exception as e:
-            print(f"Attempt {attempt} error: {e}")
+            log.warning(f"Attempt {attempt} error: {e}")
         
         if attempt < 4:
             time.sleep(delay)
     
-    print("❌ All notification attempts failed")
+    RETRIES.labels("notify").observe(attempt - 1)
+    log.error("❌ All notification attempts failed")
+
+
+ledger_db: sqlite3.Connection | None = None
+ledger_lock = threading.Lock()
+
+
+def ledger_init():
+    """Open the task ledger, creating its table on first use."""
+    global ledger_db
+    ledger_db = sqlite3.connect(TASK_LEDGER_PATH, timeout=30, check_same_thread=False)
+    ledger_db.row_factory = sqlite3.Row
+    with ledger_lock, ledger_db:
+        ledger_db.execute("""CREATE TABLE IF NOT EXISTS tasks (
+            task TEXT NOT NULL,
+            nonce TEXT NOT NULL,
+            round INTEGER NOT NULL,
+            job_id TEXT NOT NULL,
+            status TEXT NOT NULL,
+            request TEXT NOT NULL,
+            stages TEXT NOT NULL DEFAULT '{}',
+            error TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (task, nonce, round)
+        )""")
+        ledger_db.execute("CREATE INDEX IF NOT EXISTS tasks_job_id ON tasks (job_id)")
+        ledger_db.execute("""CREATE TABLE IF NOT EXISTS warm_repos (
+            name TEXT PRIMARY KEY,
+            claimed_by TEXT,
+            created_at REAL NOT NULL
+        )""")
+        columns = [row["name"] for row in ledger_db.execute("PRAGMA table_info(warm_repos)")]
+        if "claimed_at" not in columns:
+            ledger_db.execute("ALTER TABLE warm_repos ADD COLUMN claimed_at REAL")
+
+
+def ledger_row(row: sqlite3.Row | None) -> dict | None:
+    if row is None:
+        return None
+    record = dict(row)
+    record["request"] = json.loads(record["request"])
+    record["stages"] = json.loads(record["stages"])
+    return record
+
+
+def ledger_get(task: str, nonce: str, round_: int) -> dict | None:
+    """Return the ledger record for a task, or None if it was never accepted."""
+    with ledger_lock:
+        row = ledger_db.execute(
+            "SELECT * FROM tasks WHERE task = ? AND nonce = ? AND round = ?", (task, nonce, round_)
+        ).fetchone()
+    return ledger_row(row)
+
+
+def ledger_get_job(job_id: str) -> dict | None:
+    with ledger_lock:
+        row = ledger_db.execute("SELECT * FROM tasks WHERE job_id = ?", (job_id,)).fetchone()
+    return ledger_row(row)
+
+
+def ledger_unfinished() -> list[dict]:
+    with ledger_lock:
+        rows = ledger_db.execute(
+            "SELECT * FROM tasks WHERE status IN ('queued', 'running') ORDER BY created_at"
+        ).fetchall()
+    return [ledger_row(row) for row in rows]
+
+
+def ledger_queue(data: dict, job_id: str):
+    """Record a task as queued, keeping the stages a previous attempt finished."""
+    request = {k: v for k, v in data.items() if k.lower() != "secret"}
+    now = time.time()
+    with ledger_lock, ledger_db:
+        ledger_db.execute(
+            """INSERT INTO tasks (task, nonce, round, job_id, status, request, created_at, updated_at)
+            VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)
+            ON CONFLICT (task, nonce, round) DO UPDATE SET
+                job_id = excluded.job_id, status = 'queued', request = excluded.request,
+                error = NULL, updated_at = excluded.updated_at""",
+            (data["task"], data["nonce"], data["round"], job_id, json.dumps(request), now, now),
+        )
+
+
+def ledger_update(job: dict, status: str | None = None, stage: str | None = None, result=None):
+    """Record a job's status and/or the result of a stage it finished."""
+    key = (job["task"], job["nonce"], job["round"])
+    with ledger_lock, ledger_db:
+        if stage is not None:
+            row = ledger_db.execute(
+                "SELECT stages FROM tasks WHERE task = ? AND nonce = ? AND round = ?", key
+            ).fetchone()
+            stages = json.loads(row["stages"]) if row else {}
+            stages[stage] = result
+            ledger_db.execute(
+                "UPDATE tasks SET stages = ?, updated_at = ? WHERE task = ? AND nonce = ? AND round = ?",
+                (json.dumps(stages), time.time(), *key),
+            )
+        if status is not None:
+            ledger_db.execute(
+                "UPDATE tasks SET status = ?, error = ?, updated_at = ? WHERE task = ? AND nonce = ? AND round = ?",
+                (status, job["error"], time.time(), *key),
+            )
+
+
+class Coordination(ABC):
+    """State shared by every worker process: a job queue, leases and a cache.
+
+    Jobs are queued under their task key, so a task is queued at most once
+    however many workers receive it. A claimed job holds a lease its worker
+    renews; if the worker dies the lease expires and the job is claimed
+    again by the next worker that asks.
+    """
+
+    # Whether the cache is shared between hosts, not only between the processes of one host
+    spans_hosts = False
+
+    @abstractmethod
+    def submit(self, key: str, job_id: str, request: dict) -> tuple[str, str | None]:
+        """Queue a task unless it is already queued, running or completed.
+
+        Returns the task's job id and its existing status, or None as status
+        if it was queued now. A failed task is queued again under its old id.
+        """
+
+    @abstractmethod
+    def claim(self, owner: str, ttl: float) -> tuple[str, str, dict] | None:
+        """Take the oldest claimable job for owner; returns (key, job id, request)."""
+
+    @abstractmethod
+    def heartbeat(self, key: str, owner: str, ttl: float) -> bool:
+        """Extend owner's claim on a job; False if the claim was lost."""
+
+    @abstractmethod
+    def finish(self, key: str, owner: str, status: str) -> bool:
+        """Mark owner's job completed or failed, or hand it back with "queued"."""
+
+    @abstractmethod
+    def queued_count(self) -> int:
+        ...
+
+    @abstractmethod
+    def acquire(self, name: str, owner: str, ttl: float) -> bool:
+        """Take the named lease for ttl seconds if it is free or already owner's."""
+
+    @abstractmethod
+    def renew(self, name: str, owner: str, ttl: float) -> bool:
+        """Extend owner's lease; False if it expired or is held by someone else."""
+
+    @abstractmethod
+    def release(self, name: str, owner: str):
+        ...
+
+    @abstractmethod
+    def cache_get(self, key: str) -> str | None:
+        ...
+
+    @abstractmethod
+    def cache_set(self, key: str, value: str, ttl: float):
+        ...
+
+
+class SQLiteCoordination(Coordination):
+    """Coordination through a SQLite file, for worker processes on one host.
+
+    Every check-and-set runs in a BEGIN IMMEDIATE transaction, which takes
+    SQLite's write lock on the file, so it is atomic across processes.
+    """
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        with self.transaction() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS coord_jobs (
+                key TEXT PRIMARY KEY,
+                job_id TEXT NOT NULL,
+                status TEXT NOT NULL,
+                request TEXT NOT NULL,
+                owner TEXT,
+                lease_until REAL,
+                queued_at REAL NOT NULL
+            )""")
+            db.execute("CREATE INDEX IF NOT EXISTS coord_jobs_status ON coord_jobs (status, queued_at)")
+            db.execute("""CREATE TABLE IF NOT EXISTS coord_leases (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )""")
+            db.execute("""CREATE TABLE IF NOT EXISTS coord_cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )""")
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def submit(self, key, job_id, request):
+        with self.transaction() as db:
+            row = db.execute("SELECT job_id, status FROM coord_jobs WHERE key = ?", (key,)).fetchone()
+            if row and row["status"] != "failed":
+                return row["job_id"], row["status"]
+            job_id = row["job_id"] if row else job_id
+            db.execute(
+                """INSERT OR REPLACE INTO coord_jobs (key, job_id, status, request, queued_at)
+                VALUES (?, ?, 'queued', ?, ?)""",
+                (key, job_id, json.dumps(request), time.time()),
+            )
+        return job_id, None
+
+    def claim(self, owner, ttl):
+        now = time.time()
+        with self.transaction() as db:
+            row = db.execute(
+                """SELECT key, job_id, request FROM coord_jobs
+                WHERE status = 'queued' OR (status = 'running' AND lease_until < ?)
+                ORDER BY queued_at LIMIT 1""",
+                (now,),
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "UPDATE coord_jobs SET status = 'running', owner = ?, lease_until = ? WHERE key = ?",
+                (owner, now + ttl, row["key"]),
+            )
+        return row["key"], row["job_id"], json.loads(row["request"])
+
+    def heartbeat(self, key, owner, ttl):
+        with self.transaction() as db:
+            return db.execute(
+                "UPDATE coord_jobs SET lease_until = ? WHERE key = ? AND owner = ? AND status = 'running'",
+                (time.time() + ttl, key, owner),
+            ).rowcount > 0
+
+    def finish(self, key, owner, status):
+        with self.transaction() as db:
+            return db.execute(
+                """UPDATE coord_jobs SET status = ?, owner = NULL, lease_until = NULL
+                WHERE key = ? AND owner = ? AND status = 'running'""",
+                (status, key, owner),
+            ).rowcount > 0
+
+    def queued_count(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM coord_jobs WHERE status = 'queued'").fetchone()[0]
+
+    def acquire(self, name, owner, ttl):
+        now = time.time()
+        with self.transaction() as db:
+            row = db.execute("SELECT owner, expires_at FROM coord_leases WHERE name = ?", (name,)).fetchone()
+            if row and row["owner"] != owner and row["expires_at"] > now:
+                return False
+            db.execute(
+                "INSERT OR REPLACE INTO coord_leases (name, owner, expires_at) VALUES (?, ?, ?)",
+                (name, owner, now + ttl),
+            )
+        return True
+
+    def renew(self, name, owner, ttl):
+        now = time.time()
+        with self.transaction() as db:
+            return db.execute(
+                "UPDATE coord_leases SET expires_at = ? WHERE name = ? AND owner = ? AND expires_at > ?",
+                (now + ttl, name, owner, now),
+            ).rowcount > 0
+
+    def release(self, name, owner):
+        with self.transaction() as db:
+            db.execute("DELETE FROM coord_leases WHERE name = ? AND owner = ?", (name, owner))
+
+    def cache_get(self, key):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value FROM coord_cache WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+        return row["value"] if row else None
+
+    def cache_set(self, key, value, ttl):
+        now = time.time()
+        with self.transaction() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO coord_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, now + ttl),
+            )
+            if random.random() < 0.01:
+                db.execute("DELETE FROM coord_cache WHERE expires_at <= ?", (now,))
+
+
+class RedisCoordination(Coordination):
+    """Coordination through Redis, for worker processes on several hosts.
+
+    Takes any client with the redis-py interface created with
+    decode_responses=True, so tests can pass a fakeredis client. Every
+    check-and-set is a WATCH/MULTI transaction; no Lua scripts are needed.
+    """
+
+    spans_hosts = True
+
+    def __init__(self, client, prefix: str = "deployer:"):
+        self.redis = client
+        self.prefix = prefix
+
+    def k(self, *parts: str) -> str:
+        return self.prefix + ":".join(parts)
+
+    def submit(self, key, job_id, request):
+        job_key = self.k("job", key)
+
+        def txn(pipe):
+            current = pipe.hgetall(job_key)
+            if current and current["status"] != "failed":
+                return current["job_id"], current["status"]
+            queued_id = current.get("job_id", job_id)
+            pipe.multi()
+            pipe.hset(job_key, mapping={"job_id": queued_id, "status": "queued", "request": json.dumps(request), "owner": ""})
+            pipe.zadd(self.k("queue"), {key: time.time()})
+            return queued_id, None
+        return self.redis.transaction(txn, job_key, value_from_callable=True)
+
+    def claim_key(self, key: str, source: str, owner: str, ttl: float) -> tuple[str, str, dict] | None:
+        """Move key from the source sorted set to running, if it is still there."""
+        job_key = self.k("job", key)
+        now = time.time()
+
+        def txn(pipe):
+            score = pipe.zscore(self.k(source), key)
+            if score is None or (source == "running" and score >= now):
+                return None
+            job = pipe.hgetall(job_key)
+            pipe.multi()
+            pipe.zrem(self.k(source), key)
+            pipe.hset(job_key, mapping={"status": "running", "owner": owner})
+            pipe.zadd(self.k("running"), {key: now + ttl})
+            return key, job["job_id"], json.loads(job["request"])
+        return self.redis.transaction(txn, self.k(source), job_key, value_from_callable=True)
+
+    def claim(self, owner, ttl):
+        # Jobs whose worker stopped renewing come first, they were queued earliest
+        for key in self.redis.zrangebyscore(self.k("running"), 0, time.time(), start=0, num=5):
+            claimed = self.claim_key(key, "running", owner, ttl)
+            if claimed:
+                return claimed
+        while True:
+            head = self.redis.zrange(self.k("queue"), 0, 0)
+            if not head:
+                return None
+            claimed = self.claim_key(head[0], "queue", owner, ttl)
+            if claimed:
+                return claimed
+
+    def heartbeat(self, key, owner, ttl):
+        job_key = self.k("job", key)
+
+        def txn(pipe):
+            if pipe.hget(job_key, "owner") != owner or pipe.hget(job_key, "status") != "running":
+                return False
+            pipe.multi()
+            pipe.zadd(self.k("running"), {key: time.time() + ttl})
+            return True
+        return self.redis.transaction(txn, job_key, value_from_callable=True)
+
+    def finish(self, key, owner, status):
+        job_key = self.k("job", key)
+
+        def txn(pipe):
+            if pipe.hget(job_key, "owner") != owner:
+                return False
+            pipe.multi()
+            pipe.hset(job_key, mapping={"status": status, "owner": ""})
+            pipe.zrem(self.k("running"), key)
+            if status == "queued":
+                pipe.zadd(self.k("queue"), {key: time.time()})
+            return True
+        return self.redis.transaction(txn, job_key, value_from_callable=True)
+
+    def queued_count(self):
+        return self.redis.zcard(self.k("queue"))
+
+    def acquire(self, name, owner, ttl):
+        lease_key = self.k("lease", name)
+
+        def txn(pipe):
+            if pipe.get(lease_key) not in (None, owner):
+                return False
+            pipe.multi()
+            pipe.set(lease_key, owner, px=int(ttl * 1000))
+            return True
+        return self.redis.transaction(txn, lease_key, value_from_callable=True)
+
+    def renew(self, name, owner, ttl):
+        lease_key = self.k("lease", name)
+
+        def txn(pipe):
+            if pipe.get(lease_key) != owner:
+                return False
+            pipe.multi()
+            pipe.pexpire(lease_key, int(ttl * 1000))
+            return True
+        return self.redis.transaction(txn, lease_key, value_from_callable=True)
+
+    def release(self, name, owner):
+        lease_key = self.k("lease", name)
+
+        def txn(pipe):
+            if pipe.get(lease_key) == owner:
+                pipe.multi()
+                pipe.delete(lease_key)
+        self.redis.transaction(txn, lease_key)
+
+    def cache_get(self, key):
+        return self.redis.get(self.k("cache", key))
+
+    def cache_set(self, key, value, ttl):
+        self.redis.set(self.k("cache", key), value, px=int(ttl * 1000))
+
+
+def coordination_from_url(url: str) -> Coordination:
+    """Open the coordination backend COORDINATION_URL points at."""
+    if url.startswith("sqlite:///"):
+        return SQLiteCoordination(url[len("sqlite:///"):])
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("COORDINATION_URL is a Redis URL but the redis package is not installed") from None
+        return RedisCoordination(redis.Redis.from_url(url, decode_responses=True))
+    raise ValueError(f"Unsupported COORDINATION_URL: {url}")
+
+
+coordination: Coordination | None = None
+
+
+def task_key(data: dict) -> str:
+    return f"{data['task']}_{data['nonce']}:{data['round']}"
+
+
+async def publish_job(job: dict):
+    """Share the job's record so every worker process can answer GET /jobs/{id}."""
+    try:
+        snapshot = json.dumps(job, default=str)
+        await run_in(coordination_pool, coordination.cache_set, f"job:{job['id']}", snapshot, JOB_SNAPSHOT_TTL)
+    except Exception as e:
+        # LLM threads may update llm_progress mid-dump; the next stage publishes again
+        log.warning(f"⚠️ Could not publish job {job['id']}: {e}")
+
+
+async def keep_lease(renew, what: str, work: asyncio.Task):
+    """Call renew() every LEASE_TTL / 3 while work runs; cancel work if the lease is lost."""
+    while True:
+        await asyncio.sleep(LEASE_TTL / 3)
+        try:
+            held = await run_in(coordination_pool, renew)
+        except Exception as e:
+            log.warning(f"⚠️ Could not renew lease on {what}: {e}")
+            continue
+        if not held:
+            log.error(f"❌ Lost lease on {what}, stopping")
+            work.cancel()
+            return
+
+
+@asynccontextmanager
+async def repo_lease(job: dict, repo_name: str):
+    """Hold the repo's lease for the block, so one job at a time writes to it.
+
+    Waits up to REPO_LEASE_WAIT for another job to release the lease or
+    for it to expire.
+    """
+    name, owner = f"repo:{repo_name}", f"{WORKER_ID}:{job['id']}"
+    deadline = time.monotonic() + REPO_LEASE_WAIT
+    while not await run_in(coordination_pool, coordination.acquire, name, owner, LEASE_TTL):
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Repo {repo_name} stayed leased for {REPO_LEASE_WAIT}s")
+        if job["stage"] != "repo_lease":
+            job["stage"] = "repo_lease"
+            log.info(f"Waiting for another job to finish with {repo_name}")
+        await asyncio.sleep(random.uniform(0.5, 2))
+    keeper = asyncio.create_task(keep_lease(
+        lambda: coordination.renew(name, owner, LEASE_TTL), name, asyncio.current_task(),
+    ))
+    try:
+        yield
+    finally:
+        keeper.cancel()
+        await run_in(coordination_pool, coordination.release, name, owner)
+
+
+def warm_pool_count() -> int:
+    with ledger_lock:
+        return ledger_db.execute(
+            "SELECT COUNT(*) FROM warm_repos WHERE claimed_by IS NULL OR COALESCE(claimed_at, 0) < ?",
+            (time.time() - WARM_CLAIM_TIMEOUT,),
+        ).fetchone()[0]
+
+
+def create_warm_repo() -> str:
+    """Create one pool repo with Pages enabled and record it as ready."""
+    name = f"{WARM_POOL_PREFIX}{uuid.uuid4().hex[:12]}"
+    create_repo_with_pages(name)
+    with ledger_lock, ledger_db:
+        ledger_db.execute("INSERT INTO warm_repos (name, created_at) VALUES (?, ?)", (name, time.time()))
+    return name
+
+
+async def warm_pool_filler():
+    """Keep WARM_POOL_SIZE unclaimed repos ready, creating them one at a time.
+
+    Only the process holding this host's warm pool lease refills, so
+    several workers sharing the ledger don't overshoot the pool size.
+    """
+    lease = f"warm-pool:{WORKER_HOST}"
+    delay = WARM_POOL_CHECK_INTERVAL
+    while True:
+        try:
+            if (await run_in(coordination_pool, coordination.acquire, lease, WORKER_ID, LEASE_TTL)
+                    and await run_in(coordination_pool, warm_pool_count) < WARM_POOL_SIZE):
+                name = await run_in(stage_pool, create_warm_repo)
+                log.info(f"✅ Warm repo {name} ready ({await run_in(coordination_pool, warm_pool_count)}/{WARM_POOL_SIZE})")
+                delay = WARM_POOL_CHECK_INTERVAL
+                continue
+        except Exception as e:
+            log.error(f"❌ Warm pool refill failed: {e}")
+            delay = min(delay * 2, 300)
+        await asyncio.sleep(delay)
+
+
+def claim_warm_repo(repo_name: str) -> str | None:
+    """Claim the oldest ready pool repo for repo_name, or None if the pool is empty.
+
+    A single UPDATE picks and claims the repo, so concurrent claims from
+    other processes never get the same one. Claims older than
+    WARM_CLAIM_TIMEOUT were cut off before the rename and count as free.
+    """
+    now = time.time()
+    with ledger_lock, ledger_db:
+        row = ledger_db.execute(
+            """UPDATE warm_repos SET claimed_by = ?, claimed_at = ? WHERE name = (
+                SELECT name FROM warm_repos
+                WHERE claimed_by IS NULL OR COALESCE(claimed_at, 0) < ?
+                ORDER BY created_at LIMIT 1
+            ) RETURNING name""",
+            (repo_name, now, now - WARM_CLAIM_TIMEOUT),
+        ).fetchone()
+    return row["name"] if row else None
+
+
+def repo_exists(repo_name: str) -> bool:
+    """Whether repo_name exists under its own name (renamed repos' redirects don't count)."""
+    try:
+        github_request("GET", f"/repos/{GITHUB_USERNAME}/{repo_name}", allow_redirects=False)
+        return True
+    except GitHubAPIError as e:
+        if e.status_code in (301, 307, 404):
+            return False
+        raise
+
+
+def warm_rename_outcome(warm_name: str, repo_name: str, error: Exception) -> str:
+    """Work out what a failed rename of warm_name to repo_name did.
+
+    Returns "renamed" if the repo now has its new name, "exists" if
+    repo_name was already taken (by an earlier, cut-off attempt of this
+    job), "free" if the rename was refused and warm_name is still a pool
+    repo, or "gone" if
+    the pool row can't be trusted any more: warm_name was already renamed
+    (GitHub redirects its old name) or the outcome can't be confirmed.
+    """
+    if isinstance(error, GitHubAPIError):
+        if error.status_code in (301, 307, 404):
+            return "gone"
+        if error.status_code == 422 and "already exists" in error.text:
+            return "exists"
+        if error.status_code < 500:
+            return "free"
+    # A timeout, reset or 5xx may come after GitHub applied the rename
+    try:
+        return "renamed" if repo_exists(repo_name) else "free"
+    except Exception:
+        return "gone"
+
+
+def claim_or_create_repo(repo_name: str):
+    """Rename a warm pool repo to repo_name, or create the repo from scratch.
+
+    Pool repos already have the MIT license committed and Pages enabled,
+    so a claim costs one PATCH instead of creation, readiness polling and
+    Pages setup. The PATCH doesn't follow redirects, so a stale pool row
+    whose repo was already renamed can never rename another task's repo;
+    such rows are dropped and the next pool repo is tried. A repo whose
+    rename was refused goes back to the pool.
+
+    If repo_name already exists, a retry of this job got cut off after an
+    earlier rename or creation, and that repo is adopted as it is.
+    """
+    if WARM_POOL_SIZE > 0 and repo_exists(repo_name):
+        log.info(f"Repository {repo_name} already exists, adopting it")
+        return
+    while True:
+        warm_name = claim_warm_repo(repo_name) if WARM_POOL_SIZE > 0 else None
+        if warm_name is None:
+            create_repo_with_pages(repo_name)
+            return
+        
+        log.info(f"Claiming warm repo {warm_name} as {repo_name}")
+        try:
+            github_request(
+                "PATCH", f"/repos/{GITHUB_USERNAME}/{warm_name}", json={"name": repo_name}, allow_redirects=False,
+            )
+            outcome = "renamed"
+        except Exception as e:
+            outcome = warm_rename_outcome(warm_name, repo_name, e)
+            log.warning(f"⚠️ Rename of warm repo {warm_name} failed ({e}), outcome: {outcome}")
+            error = e
+        
+        with ledger_lock, ledger_db:
+            if outcome in ("free", "exists"):
+                ledger_db.execute("UPDATE warm_repos SET claimed_by = NULL WHERE name = ?", (warm_name,))
+            else:
+                ledger_db.execute("DELETE FROM warm_repos WHERE name = ?", (warm_name,))
+        if outcome in ("renamed", "exists"):
+            return
+        # Only a pool row known to be stale is worth replacing with the next one
+        if not (isinstance(error, GitHubAPIError) and error.status_code in (301, 307, 404)):
+            raise error
+
+
+def new_job(data: dict, job_id: str | None = None, register: bool = True) -> dict:
+    """Create a job record for an accepted task request.
+
+    Only the process running the job registers it in `jobs`; others
+    publish it for GET /jobs/{id} without keeping a copy that goes stale.
+    """
+    # Drop the oldest finished jobs so the history does not grow forever
+    if len(jobs) >= JOB_HISTORY_LIMIT:
+        finished = [j for j in jobs.values() if j["status"] in ("completed", "failed")]
+        for old in sorted(finished, key=lambda j: j["created_at"])[:len(jobs) - JOB_HISTORY_LIMIT + 1]:
+            jobs.pop(old["id"], None)
+
+    repo_name = f"{data['task']}_{data['nonce']}"
+    job = {
+        "id": job_id or uuid.uuid4().hex,
+        "task": data["task"],
+        "round": data["round"],
+        "nonce": data["nonce"],
+        "status": "queued",
+        "stage": "queued",
+        "active_stages": [],
+        "timings": {},
+        "trace": [],
+        "error": None,
+        "repo_url": f"https://github.com/{GITHUB_USERNAME}/{repo_name}",
+        "pages_url": f"https://{GITHUB_USERNAME}.github.io/{repo_name}/",
+        "created_at": time.time(),
+        "started_at": None,
+        "finished_at": None,
+    }
+    if register:
+        jobs[job["id"]] = job
+    return job
+
+
+async def run_stage(job: dict, stage: str, func, *args):
+    """Run one pipeline stage under its timeout and record how long it took.
+
+    Blocking functions run in a worker thread so the event loop stays free.
+    Stages may run concurrently; `stage` lists every one still in flight.
+    A stage the ledger already has a result for is skipped and that result
+    returned, so a retried task resumes after the last stage that succeeded.
+    """
+    record = await run_in(coordination_pool, ledger_get, job["task"], job["nonce"], job["round"])
+    if record and stage in record["stages"]:
+        log.info(f"Skipping stage '{stage}' for job {job['id']} (already done)")
+        return record["stages"][stage]
+    
+    current_job.set(job)
+    job["active_stages"].append(stage)
+    job["stage"] = "+".join(job["active_stages"])
+    await publish_job(job)
+    start = time.perf_counter()
+    thread = None
+    try:
+        if inspect.iscoroutinefunction(func):
+            coro = func(*args)
+        else:
+            thread = asyncio.ensure_future(run_in(stage_pool, func, *args))
+            coro = asyncio.shield(thread) if stage in REPO_WRITE_STAGES else thread
+        with span("stage", stage=stage) as s:
+            try:
+                result = await asyncio.wait_for(coro, STAGE_TIMEOUTS.get(stage))
+            except asyncio.TimeoutError:
+                s["status"] = "timeout"
+                raise TimeoutError(f"Stage '{stage}' timed out after {STAGE_TIMEOUTS[stage]}s") from None
+    except BaseException:
+        # A thread can't be interrupted, so one that writes to the repo finishes
+        # before the job gives up its repo lease
+        if thread is not None and stage in REPO_WRITE_STAGES and not thread.done():
+            log.warning(f"⚠️ Waiting for stage '{stage}' to stop writing to the repo")
+            await asyncio.wait([thread])
+        raise
+    finally:
+        job["timings"][stage] = round(time.perf_counter() - start, 3)
+        job["active_stages"].remove(stage)
+        if job["active_stages"]:
+            job["stage"] = "+".join(job["active_stages"])
+    
+    await run_in(coordination_pool, ledger_update, job, stage=stage, result=result)
+    await publish_job(job)
+    return result
+
+
+# Stages that write to the repo, which must stop before its lease is released
+REPO_WRITE_STAGES = {"create_repo", "push"}
+
+
+async def process_job(job: dict, data: dict):
+    """Run generate -> push -> notify for one task, holding the repo's lease."""
+    repo_name = f"{data['task']}_{data['nonce']}"
+
+    async def prepare_and_generate(generate, *args):
+        attachments = await run_stage(job, "attachments", fetch_attachments, data.get("attachments", []))
+        files = await run_stage(job, "generate", generate, *args, data["brief"], data.get("checks", []), attachments)
+        return files + attachment_files(attachments)
+
+    async with repo_lease(job, repo_name):
+        if data["round"] == 1:
+            # Repo creation doesn't need the generated code, so overlap the two;
+            # if either fails the other is cancelled before the lease is released
+            try:
+                async with asyncio.TaskGroup() as group:
+                    generated = group.create_task(prepare_and_generate(generate_app_code))
+                    group.create_task(run_stage(job, "create_repo", claim_or_create_repo, repo_name))
+            except ExceptionGroup as e:
+                raise e.exceptions[0] from None
+            files = generated.result()
+            commit_sha = await run_stage(job, "push", push_new_app, repo_name, files)
+        else:
+            files = await prepare_and_generate(update_app_code, repo_name)
+            commit_sha = await run_stage(job, "push", update_repo_files, repo_name, files)
+
+        # Wait for GitHub Pages to deploy our commit; notify anyway if it is slow or fails
+        await run_stage(job, "pages_wait", wait_for_pages_build, repo_name, commit_sha)
+
+        # Notify evaluation endpoint
+        await run_stage(job, "notify", notify_evaluation, data)
+
+
+async def job_worker(worker_id: int):
+    """Claim jobs from the shared queue and process them one at a time.
+
+    The claim is renewed while the job runs. If it is lost (this process
+    stalled past LEASE_TTL and another worker took the job over) the job
+    is cancelled here; on shutdown it is handed back to the queue.
+    """
+    owner = f"{WORKER_ID}:{worker_id}"
+    while True:
+        claimed = await run_in(coordination_pool, coordination.claim, owner, LEASE_TTL)
+        if claimed is None:
+            jobs_available.clear()
+            try:
+                await asyncio.wait_for(jobs_available.wait(), JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        
+        key, job_id, data = claimed
+        job = new_job(data, job_id)
+        current_job.set(job)
+        job["status"] = "running"
+        job["started_at"] = time.time()
+        job["worker"] = owner
+        await run_in(coordination_pool, ledger_queue, data, job_id)
+        await run_in(coordination_pool, ledger_update, job, status="running")
+        await publish_job(job)
+        JOBS_RUNNING.inc()
+        log.info(f"Worker {owner} picked up job {job['id']} ({job['task']}, round {job['round']})")
+        lease_lost = False
+        work = asyncio.create_task(process_job(job, data))
+        keeper = asyncio.create_task(keep_lease(
+            lambda: coordination.heartbeat(key, owner, LEASE_TTL), f"job {job['id']}", work,
+        ))
+        try:
+            await work
+            job["status"] = "completed"
+            job["stage"] = "done"
+            await run_in(coordination_pool, ledger_update, job, status="completed")
+            log.info(f"✅ Round {job['round']} completed successfully (job {job['id']})")
+        except asyncio.CancelledError:
+            job["status"] = "failed"
+            if asyncio.current_task().cancelling():
+                await run_in(coordination_pool, coordination.finish, key, owner, "queued")
+                raise
+            job["error"] = "Lost a lease, stopped so another worker can take the job over"
+            lease_lost = True
+        except Exception as e:
+            job["status"] = "failed"
+            job["error"] = str(e)
+            await run_in(coordination_pool, ledger_update, job, status="failed")
+            log.error(f"❌ Job {job['id']} failed in stage '{job['stage']}': {e}")
+        finally:
+            keeper.cancel()
+            job["finished_at"] = time.time()
+            JOBS_RUNNING.dec()
+        
+        JOBS_TOTAL.labels(str(job["round"]), job["status"]).inc()
+        if await run_in(coordination_pool, coordination.finish, key, owner, job["status"]):
+            # Still ours (only the repo lease was lost), so no other worker writes its ledger row
+            if lease_lost:
+                await run_in(coordination_pool, ledger_update, job, status="failed")
+            await publish_job(job)
 
 
 @app.get("/")
 async def root():
     """Health check endpoint."""
-    return {"status": "running", "message": "Task handler is ready"}
+    return {
+        "status": "running",
+        "message": "Task handler is ready",
+        "worker": WORKER_ID,
+        "queued_jobs": await run_in(coordination_pool, coordination.queued_count),
+        "llm_cache": {**llm_cache_stats, "memory_items": len(llm_cache)},
+        "llm_routes": llm_stats_summary(),
+        "warm_repos": await run_in(coordination_pool, warm_pool_count) if WARM_POOL_SIZE > 0 else None,
+        "github_rate_limit": {
+            "remaining": github_limits["remaining"],
+            "reset": github_limits["reset"],
+            "paused_for": max(0, round(github_limits["paused_until"] - time.time(), 1)),
+        },
+    }
 
 
 @app.post("/handle_task")
 async def handle_task(data: dict):
-    """Main endpoint to handle task requests."""
-    print(f"\n{'='*50}")
-    print(f"Received task request")
-    print(f"Task: {data.get('task', 'N/A')}")
-    print(f"Round: {data.get('round', 'N/A')}")
-    print(f"Nonce: {data.get('nonce', 'N/A')}")
-    print(f"{'='*50}\n")
+    """Validate a task request and queue it for the worker pool."""
+    log.info(f"Received task request: task={data.get('task', 'N/A')} "
+             f"round={data.get('round', 'N/A')} nonce={data.get('nonce', 'N/A')}")
     
     # Validate secret (case-insensitive for 'secret' key)
     incoming_secret = data.get("secret") or data.get("SECRET")
     if not validate_secret(incoming_secret):
-        print("❌ Invalid secret provided")
+        log.error("❌ Invalid secret provided")
         return {"error": "Invalid secret"}
     
-    repo_name = f"{data['task']}_{data['nonce']}"
-    round_num = data["round"]
+    missing = [f for f in ("task", "nonce", "round", "brief", "evaluation_url") if not data.get(f)]
+    if missing:
+        return {"error": f"Missing required fields: {', '.join(missing)}"}
     
-    try:
-        if round_num == 1:
-            files = generate_app_code(
-                data["brief"], 
-                data.get("checks", []), 
-                data.get("attachments", [])
-            )
-            create_repo_with_pages(repo_name, files)
-        elif round_num == 2:
-            files = update_app_code(
-                repo_name, 
-                data["brief"], 
-                data.get("checks", [])
-            )
-            update_repo_files(repo_name, files)
-        else:
-            return {"error": "Invalid round number. Must be 1 or 2."}
-        
-        # Wait for GitHub Pages to deploy
-        time.sleep(5)
-        
-        # Notify evaluation endpoint
-        notify_evaluation(data)
-        
-        print(f"✅ Round {round_num} completed successfully")
-        return {
-            "message": f"Round {round_num} completed successfully",
-            "repo_url": f"https://github.com/{GITHUB_USERNAME}/{repo_name}",
-            "pages_url": f"https://{GITHUB_USERNAME}.github.io/{repo_name}/"
-        }
+    if data["round"] not in (1, 2):
+        return {"error": "Invalid round number. Must be 1 or 2."}
     
-    except Exception as e:
-        print(f"❌ Error: {str(e)}")
+    queued = await run_in(coordination_pool, coordination.queued_count)
+    if queued >= MAX_QUEUED_JOBS:
+        log.error("❌ Job queue is full")
+        return {"error": "Job queue is full, try again later"}
+
+    # Only references to the decoded files are queued and kept in the ledger
+    try:
+        data["attachments"] = await run_in(
+            coordination_pool, store_request_attachments, data.get("attachments", []),
+        )
+    except ValueError as e:
+        log.error(f"❌ {e}")
         return {"error": str(e)}
 
+    # Retries of a finished or in-flight task get the existing job instead of a new run,
+    # whichever worker process or host received the first request
+    request = {k: v for k, v in data.items() if k.lower() != "secret"}
+    job_id, existing = await run_in(coordination_pool, coordination.submit, task_key(data), uuid.uuid4().hex, request)
+    if existing is not None:
+        log.info(f"Duplicate request for job {job_id} ({existing})")
+        return task_accepted(job_id, data, existing, duplicate=True)
+    
+    await publish_job(new_job(data, job_id, register=False))
+    jobs_available.set()
+    log.info(f"Queued job {job_id} ({queued + 1} waiting)")
+    return task_accepted(job_id, data, "queued")
+
+
+def task_accepted(job_id: str, data: dict, status: str, duplicate: bool = False) -> dict:
+    """Build the /handle_task response for an accepted job."""
+    repo_name = f"{data['task']}_{data['nonce']}"
+    return {
+        "message": f"Round {data['round']} task accepted",
+        "job_id": job_id,
+        "status": status,
+        "duplicate": duplicate,
+        "status_url": f"/jobs/{job_id}",
+        "repo_url": f"https://github.com/{GITHUB_USERNAME}/{repo_name}",
+        "pages_url": f"https://{GITHUB_USERNAME}.github.io/{repo_name}/",
+    }
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, trace: bool = False):
+    """Report the current stage and per-stage timings of a job.
+
+    With ?trace=true the job's spans (stages and external calls) are included.
+    """
+    # A job this process is running is the freshest; otherwise the shared copy
+    # is, since the job may have run (or been retried) in another process
+    job = jobs.get(job_id)
+    if job is None or job["status"] not in ("queued", "running"):
+        shared = await run_in(coordination_pool, coordination.cache_get, f"job:{job_id}")
+        job = json.loads(shared) if shared else job
+    if job is not None:
+        return job if trace else {k: v for k, v in job.items() if k != "trace"}
+    
+    # Fall back to the ledger for jobs from before a restart or evicted from memory
+    record = await run_in(coordination_pool, ledger_get_job, job_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {
+        "id": record["job_id"],
+        "task": record["task"],
+        "round": record["round"],
+        "nonce": record["nonce"],
+        "status": record["status"],
+        "completed_stages": list(record["stages"]),
+        "error": record["error"],
+    }
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics: stage and external call latency, tokens, retries, jobs."""
+    JOBS_QUEUED.set(await run_in(coordination_pool, coordination.queued_count))
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
 
 if __name__ == "__main__":
     import uvicorn
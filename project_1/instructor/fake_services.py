@@ -0,0 +1,364 @@
+# /// script
+# requires-python = ">=3.11"
+# dependencies = [
+#   "fastapi[standard]",
+#   "uvicorn",
+# ]
+# ///
+
+"""Local stand-ins for the GitHub REST API, the chat-completions endpoint and
+the evaluation callback, used by send_task.py to benchmark main.py offline.
+
+Each fake takes a profile dict controlling its latency, error rate and rate
+limiting, so the same load can be replayed against fast, slow, flaky or
+throttled upstreams.
+"""
+
+import asyncio
+import base64
+import hashlib
+import json
+import random
+import socket
+import threading
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+
+GITHUB_PROFILES = {
+    # latency: mean seconds per call; error_rate: share of 502s;
+    # secondary_limit_rate: share of writes rejected with 403 + Retry-After;
+    # hourly_budget: core rate limit reported in X-RateLimit-* headers;
+    # pages_build: seconds from a push until its Pages build is "built"
+    "fast": {"latency": 0.01, "error_rate": 0.0, "secondary_limit_rate": 0.0, "hourly_budget": 5000, "pages_build": 0.5},
+    "realistic": {"latency": 0.15, "error_rate": 0.0, "secondary_limit_rate": 0.0, "hourly_budget": 5000, "pages_build": 20},
+    "flaky": {"latency": 0.15, "error_rate": 0.05, "secondary_limit_rate": 0.0, "hourly_budget": 5000, "pages_build": 20},
+    "rate-limited": {"latency": 0.15, "error_rate": 0.0, "secondary_limit_rate": 0.1, "hourly_budget": 300, "pages_build": 20},
+}
+
+LLM_PROFILES = {
+    # first_token: mean seconds to first token; tokens_per_second: stream rate
+    # (4 characters per token); stall_rate: share of requests whose first token
+    # takes stall_seconds; error_rate / limit_rate: share of 500s / 429s;
+    # html_chars: size of the generated page
+    "fast": {"first_token": 0.05, "tokens_per_second": 5000, "stall_rate": 0.0, "stall_seconds": 0,
+             "error_rate": 0.0, "limit_rate": 0.0, "html_chars": 4000},
+    "realistic": {"first_token": 1.5, "tokens_per_second": 80, "stall_rate": 0.0, "stall_seconds": 0,
+                  "error_rate": 0.0, "limit_rate": 0.0, "html_chars": 12000},
+    "stalls": {"first_token": 1.5, "tokens_per_second": 80, "stall_rate": 0.1, "stall_seconds": 60,
+               "error_rate": 0.0, "limit_rate": 0.0, "html_chars": 12000},
+    "flaky": {"first_token": 1.5, "tokens_per_second": 80, "stall_rate": 0.0, "stall_seconds": 0,
+              "error_rate": 0.05, "limit_rate": 0.05, "html_chars": 12000},
+}
+
+
+def jittered(mean: float) -> float:
+    return mean * random.uniform(0.5, 1.5)
+
+
+def git_sha(kind: str, content: bytes) -> str:
+    return hashlib.sha1(f"{kind} {len(content)}\0".encode() + content).hexdigest()
+
+
+def fake_github_app(profile: dict) -> FastAPI:
+    """An in-memory GitHub covering the repo, Git Data, contents and Pages calls main.py makes."""
+    app = FastAPI()
+    repos: dict[str, dict] = {}
+    lock = threading.Lock()
+    budget = {"remaining": profile["hourly_budget"], "reset": time.time() + 3600}
+    stats = {"requests": 0, "errors": 0, "secondary_limited": 0, "not_modified": 0}
+    app.state.stats = stats
+
+    @app.middleware("http")
+    async def upstream_behaviour(request: Request, call_next):
+        await asyncio.sleep(jittered(profile["latency"]))
+        stats["requests"] += 1
+        if time.time() > budget["reset"]:
+            budget.update(remaining=profile["hourly_budget"], reset=time.time() + 3600)
+        limit_headers = {
+            "X-RateLimit-Limit": str(profile["hourly_budget"]),
+            "X-RateLimit-Reset": str(int(budget["reset"])),
+            "X-RateLimit-Resource": "core",
+        }
+        if budget["remaining"] <= 0:
+            return JSONResponse({"message": "API rate limit exceeded"}, 403,
+                                {**limit_headers, "X-RateLimit-Remaining": "0"})
+        if random.random() < profile["error_rate"]:
+            stats["errors"] += 1
+            return JSONResponse({"message": "Server Error"}, 502)
+        if request.method != "GET" and random.random() < profile["secondary_limit_rate"]:
+            stats["secondary_limited"] += 1
+            return JSONResponse({"message": "You have exceeded a secondary rate limit"}, 403, {"Retry-After": "1"})
+
+        response = await call_next(request)
+        if response.status_code != 304:
+            budget["remaining"] -= 1
+        else:
+            stats["not_modified"] += 1
+        for name, value in {**limit_headers, "X-RateLimit-Remaining": str(budget["remaining"])}.items():
+            response.headers[name] = value
+        return response
+
+    def with_etag(request: Request, body: dict) -> Response:
+        etag = f'"{hashlib.md5(json.dumps(body, sort_keys=True).encode()).hexdigest()}"'
+        if request.headers.get("If-None-Match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+        return JSONResponse(body, headers={"ETag": etag})
+
+    def get_repo(name: str) -> dict | None:
+        with lock:
+            return repos.get(name)
+
+    def not_found():
+        return JSONResponse({"message": "Not Found"}, 404)
+
+    def put_commit(repo: dict, files: dict[str, str], parents: list[str], message: str) -> str:
+        tree_sha = git_sha("tree", json.dumps(files, sort_keys=True).encode())
+        repo["trees"][tree_sha] = dict(files)
+        sha = git_sha("commit", f"{tree_sha}{parents}{message}{uuid.uuid4()}".encode())
+        repo["commits"][sha] = {"sha": sha, "tree": {"sha": tree_sha}, "parents": [{"sha": p} for p in parents],
+                                "message": message}
+        return sha
+
+    def move_main(repo: dict, sha: str):
+        repo["main"] = sha
+        if repo["pages"]:
+            repo["build"] = {"commit": sha, "ready_at": time.time() + jittered(profile["pages_build"])}
+
+    @app.post("/user/repos")
+    async def create_repo(data: dict):
+        with lock:
+            if data["name"] in repos:
+                return JSONResponse({"message": "name already exists on this account"}, 422)
+            repo = repos[data["name"]] = {"blobs": {}, "trees": {}, "commits": {}, "pages": False, "build": None}
+            license_text = b"MIT License\n"
+            blob = git_sha("blob", license_text)
+            repo["blobs"][blob] = license_text
+            move_main(repo, put_commit(repo, {"LICENSE": blob}, [], "Initial commit"))
+        return JSONResponse({"name": data["name"]}, 201)
+
+    @app.patch("/repos/{owner}/{name}")
+    async def rename_repo(owner: str, name: str, data: dict):
+        with lock:
+            if name not in repos:
+                return not_found()
+            if data["name"] in repos:
+                return JSONResponse({"message": "name already exists on this account"}, 422)
+            repos[data["name"]] = repos.pop(name)
+        return {"name": data["name"]}
+
+    @app.get("/repos/{owner}/{name}")
+    async def get_repo_info(owner: str, name: str):
+        if get_repo(name) is None:
+            return not_found()
+        return {"name": name, "full_name": f"{owner}/{name}"}
+
+    @app.get("/repos/{owner}/{name}/git/ref/heads/main")
+    async def get_ref(request: Request, owner: str, name: str):
+        repo = get_repo(name)
+        if repo is None:
+            return not_found()
+        return with_etag(request, {"ref": "refs/heads/main", "object": {"sha": repo["main"]}})
+
+    @app.patch("/repos/{owner}/{name}/git/refs/heads/main")
+    async def update_ref(owner: str, name: str, data: dict):
+        with lock:
+            repo = repos.get(name)
+            if repo is None:
+                return not_found()
+            parents = [p["sha"] for p in repo["commits"][data["sha"]]["parents"]]
+            if repo["main"] not in parents:
+                return JSONResponse({"message": "Update is not a fast forward"}, 422)
+            move_main(repo, data["sha"])
+        return {"object": {"sha": data["sha"]}}
+
+    @app.get("/repos/{owner}/{name}/git/commits/{sha}")
+    async def get_commit(request: Request, owner: str, name: str, sha: str):
+        repo = get_repo(name)
+        if repo is None or sha not in repo["commits"]:
+            return not_found()
+        return with_etag(request, repo["commits"][sha])
+
+    @app.post("/repos/{owner}/{name}/git/blobs")
+    async def create_blob(owner: str, name: str, data: dict):
+        repo = get_repo(name)
+        if repo is None:
+            return not_found()
+        content = base64.b64decode(data["content"])
+        sha = git_sha("blob", content)
+        with lock:
+            repo["blobs"][sha] = content
+        return JSONResponse({"sha": sha}, 201)
+
+    @app.post("/repos/{owner}/{name}/git/trees")
+    async def create_tree(owner: str, name: str, data: dict):
+        with lock:
+            repo = repos.get(name)
+            if repo is None:
+                return not_found()
+            files = dict(repo["trees"].get(data.get("base_tree"), {}))
+            for entry in data["tree"]:
+                if "content" in entry:
+                    content = entry["content"].encode("utf-8")
+                    entry["sha"] = git_sha("blob", content)
+                    repo["blobs"][entry["sha"]] = content
+                files[entry["path"]] = entry["sha"]
+            tree_sha = git_sha("tree", json.dumps(files, sort_keys=True).encode())
+            repo["trees"][tree_sha] = files
+        return JSONResponse({"sha": tree_sha}, 201)
+
+    @app.post("/repos/{owner}/{name}/git/commits")
+    async def create_commit(owner: str, name: str, data: dict):
+        with lock:
+            repo = repos.get(name)
+            if repo is None:
+                return not_found()
+            sha = git_sha("commit", f"{data['tree']}{data['parents']}{data['message']}{uuid.uuid4()}".encode())
+            repo["commits"][sha] = {"sha": sha, "tree": {"sha": data["tree"]},
+                                    "parents": [{"sha": p} for p in data["parents"]], "message": data["message"]}
+        return JSONResponse({"sha": sha}, 201)
+
+    @app.get("/repos/{owner}/{name}/commits/main")
+    async def get_main_commit(request: Request, owner: str, name: str):
+        repo = get_repo(name)
+        if repo is None:
+            return not_found()
+        return with_etag(request, {"sha": repo["main"]})
+
+    @app.get("/repos/{owner}/{name}/contents/{path:path}")
+    async def get_contents(request: Request, owner: str, name: str, path: str):
+        repo = get_repo(name)
+        if repo is None:
+            return not_found()
+        files = repo["trees"][repo["commits"][repo["main"]]["tree"]["sha"]]
+        if path not in files:
+            return not_found()
+        content = repo["blobs"][files[path]]
+        return with_etag(request, {"path": path, "sha": files[path], "encoding": "base64",
+                                   "content": base64.b64encode(content).decode()})
+
+    @app.post("/repos/{owner}/{name}/pages")
+    async def enable_pages(owner: str, name: str):
+        with lock:
+            repo = repos.get(name)
+            if repo is None:
+                return not_found()
+            if repo["pages"]:
+                return JSONResponse({"message": "GitHub Pages is already enabled."}, 409)
+            repo["pages"] = True
+            move_main(repo, repo["main"])
+        return JSONResponse({"build_type": "legacy"}, 201)
+
+    @app.get("/repos/{owner}/{name}/pages/builds/latest")
+    async def latest_build(request: Request, owner: str, name: str):
+        repo = get_repo(name)
+        if repo is None or repo["build"] is None:
+            return not_found()
+        build = repo["build"]
+        built = time.time() >= build["ready_at"]
+        return with_etag(request, {"status": "built" if built else "building", "commit": build["commit"],
+                                   "error": {"message": None}, "duration": 0})
+
+    return app
+
+
+def fake_html(prompt: str, size: int) -> str:
+    """A plausible page of roughly `size` characters."""
+    filler = "\n".join(f"    <p class=\"text-gray-700\">Section {i}</p>" for i in range(max(size // 40, 1)))
+    return f"""<!DOCTYPE html>
+<html>
+<head><title>Fake App {hashlib.md5(prompt.encode()).hexdigest()[:8]}</title></head>
+<body>
+  <main id="app">
+{filler}
+  </main>
+  <script>
+    function render() {{ return new URLSearchParams(location.search).get("url"); }}
+  </script>
+</body>
+</html>"""
+
+
+def fake_completion(prompt: str, profile: dict) -> str:
+    """Reply in the shape main.py asks for: edit blocks, a fenced page or a README."""
+    if "SEARCH/REPLACE" in prompt:
+        anchor = "## Features" if "README.md" in prompt.splitlines()[0] else "</body>"
+        return f"<<<<<<< SEARCH\n{anchor}\n=======\n<!-- updated -->\n{anchor}\n>>>>>>> REPLACE\n"
+    if "HTML" in prompt:
+        return f"Here is the page:\n```html\n{fake_html(prompt, profile['html_chars'])}\n```\nThis text is never needed."
+    return "# Fake App\n\nA generated app.\n\n## Features\n\n- Fast\n\n## Setup\n\n```bash\nopen index.html\n```\n\n## License\n\nMIT\n"
+
+
+def fake_llm_app(profile: dict) -> FastAPI:
+    """An OpenRouter-style chat-completions endpoint with JSON and SSE replies."""
+    app = FastAPI()
+    stats = {"requests": 0, "errors": 0, "limited": 0, "stalled": 0, "chars_streamed": 0}
+    app.state.stats = stats
+
+    @app.post("/v1/chat/completions")
+    async def completions(data: dict):
+        stats["requests"] += 1
+        if random.random() < profile["error_rate"]:
+            stats["errors"] += 1
+            return JSONResponse({"error": {"message": "upstream error"}}, 500)
+        if random.random() < profile["limit_rate"]:
+            stats["limited"] += 1
+            return JSONResponse({"error": {"message": "rate limited"}}, 429)
+
+        text = fake_completion(data["messages"][-1]["content"], profile)
+        first_token = jittered(profile["first_token"])
+        if random.random() < profile["stall_rate"]:
+            stats["stalled"] += 1
+            first_token = profile["stall_seconds"]
+
+        if not data.get("stream"):
+            await asyncio.sleep(first_token + len(text) / 4 / profile["tokens_per_second"])
+            return {"choices": [{"message": {"role": "assistant", "content": text}, "finish_reason": "stop"}]}
+
+        async def events():
+            await asyncio.sleep(first_token)
+            yield ": PROCESSING\n\n"
+            step = 16
+            for i in range(0, len(text), step):
+                chunk = text[i:i + step]
+                stats["chars_streamed"] += len(chunk)
+                yield f"data: {json.dumps({'choices': [{'delta': {'content': chunk}, 'finish_reason': None}]})}\n\n"
+                await asyncio.sleep(len(chunk) / 4 / profile["tokens_per_second"])
+            yield f"data: {json.dumps({'choices': [{'delta': {}, 'finish_reason': 'stop'}]})}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+def fake_evaluator_app() -> FastAPI:
+    """Records every notification main.py sends."""
+    app = FastAPI()
+    app.state.notifications = []
+
+    @app.post("/notify")
+    async def notify(data: dict):
+        app.state.notifications.append({**data, "received_at": time.time()})
+        return {"status": "ok"}
+
+    return app
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(app: FastAPI, port: int | None = None) -> tuple[uvicorn.Server, str]:
+    """Serve app on a background thread; returns the server and its base URL."""
+    port = port or free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, f"http://127.0.0.1:{port}"
@@ -1,12 +1,42 @@
 # /// script
 # requires-python = ">=3.11"
 # dependencies = [
+#   "fastapi[standard]",
+#   "uvicorn",
 #   "requests",
 # ]
 # ///
 
+"""Send tasks to main.py, either one sample request or a concurrent load test.
+
+    python send_task.py                       # one sample request to localhost:8000
+    python send_task.py --load --requests 50  # load test against a running server
+    python send_task.py --load --offline      # load test against fake GitHub/LLM servers
+
+With --offline, main.py is started on a free port with GitHub, the LLM
+endpoint and the evaluation callback replaced by the fakes in
+fake_services.py, so the whole benchmark runs without network access.
+"""
+
+import argparse
+import base64
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+STAGES = ["attachments", "generate", "create_repo", "push", "pages_wait", "notify"]
+
+
 def send_task():
     payload = {
         "email": "student@example.com",
@@ -27,11 +57,214 @@ def send_task():
             "url": "data:image/png;base64,iVBORw..."
         }]
     }
-    
+
     response = requests.post("http://localhost:8000/handle_task", json=payload)
     print("Response status code:", response.status_code)
     print("Response JSON:", response.json())
 
 
+def build_payload(args, task: str, nonce: str, round_: int, evaluation_url: str) -> dict:
+    """A task request with a unique brief, so completions are never served from cache."""
+    attachments = []
+    if round_ == 1 and random.random() < args.attachment_ratio:
+        data = base64.b64encode(os.urandom(args.attachment_bytes)).decode()
+        attachments.append({"name": "sample.png", "url": f"data:image/png;base64,{data}"})
+    return {
+        "email": "bench@example.com",
+        "secret": args.secret,
+        "task": task,
+        "round": round_,
+        "nonce": nonce,
+        "brief": f"Benchmark app {uuid.uuid4().hex}: show ?url=... and a counter" if round_ == 1
+                 else f"Add a dark mode toggle ({uuid.uuid4().hex})",
+        "checks": ["Page loads", "Counter increments"],
+        "evaluation_url": evaluation_url,
+        "attachments": attachments,
+    }
+
+
+def run_job(args, payload: dict) -> dict:
+    """Submit one task and poll its job until it finishes; returns the final job record."""
+    submitted = time.time()
+    response = requests.post(f"{args.target}/handle_task", json=payload, timeout=30)
+    body = response.json()
+    if "job_id" not in body:
+        return {"status": "rejected", "error": body.get("error"), "round": payload["round"]}
+
+    deadline = submitted + args.job_timeout
+    while time.time() < deadline:
+        job = requests.get(f"{args.target}/jobs/{body['job_id']}", timeout=30).json()
+        if job["status"] in ("completed", "failed"):
+            job["end_to_end"] = time.time() - submitted
+            return job
+        time.sleep(args.poll_interval)
+    return {"status": "timed_out", "round": payload["round"]}
+
+
+def run_load(args, evaluation_url: str) -> tuple[list[dict], float]:
+    """Start args.requests round 1 tasks at args.rate per second, at most
+    args.concurrency in flight. A share of them (args.round2_ratio) is
+    followed by round 2 once round 1 finishes."""
+    results = []
+    results_lock = threading.Lock()
+    in_flight = threading.BoundedSemaphore(args.concurrency)
+
+    def task_unit(i: int):
+        try:
+            task, nonce = f"bench-{i}", uuid.uuid4().hex[:8]
+            rounds = [1, 2] if random.random() < args.round2_ratio else [1]
+            for round_ in rounds:
+                job = run_job(args, build_payload(args, task, nonce, round_, evaluation_url))
+                with results_lock:
+                    results.append(job)
+                if job["status"] != "completed":
+                    break
+        finally:
+            in_flight.release()
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for i in range(args.requests):
+            if args.rate > 0:
+                time.sleep(max(0, start + i / args.rate - time.time()))
+            in_flight.acquire()
+            pool.submit(task_unit, i)
+    return results, time.time() - start
+
+
+def percentile(samples: list[float], p: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+def report(results: list[dict], wall: float) -> dict:
+    """Print throughput and p50/p95/p99 per stage; returns the same figures."""
+    completed = [r for r in results if r["status"] == "completed"]
+    summary = {
+        "jobs": len(results),
+        "by_status": {s: sum(1 for r in results if r["status"] == s) for s in {r["status"] for r in results}},
+        "wall_seconds": round(wall, 2),
+        "throughput_per_min": round(len(completed) / wall * 60, 2) if wall else 0,
+        "stages": {},
+    }
+    for stage in [*STAGES, "end_to_end"]:
+        samples = [r["end_to_end"] if stage == "end_to_end" else r["timings"][stage]
+                   for r in completed if stage == "end_to_end" or stage in r.get("timings", {})]
+        if samples:
+            summary["stages"][stage] = {
+                "n": len(samples),
+                **{f"p{p}": round(percentile(samples, p), 3) for p in (50, 95, 99)},
+            }
+
+    print(f"\n{'=' * 60}")
+    print(f"Jobs: {summary['jobs']}  {summary['by_status']}")
+    print(f"Wall time: {summary['wall_seconds']}s  Throughput: {summary['throughput_per_min']} completed/min")
+    print(f"{'stage':<14}{'n':>6}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for stage, s in summary["stages"].items():
+        print(f"{stage:<14}{s['n']:>6}{s['p50']:>10.3f}{s['p95']:>10.3f}{s['p99']:>10.3f}")
+    for r in results:
+        if r["status"] != "completed":
+            print(f"  {r['status']}: {r.get('error')}")
+    print(f"{'=' * 60}")
+    return summary
+
+
+def profile_arg(profiles: dict, value: str) -> dict:
+    """A named profile, or a JSON object overriding fields of the "fast" profile."""
+    if value in profiles:
+        return dict(profiles[value])
+    return {**profiles["fast"], **json.loads(value)}
+
+
+def start_offline(args) -> tuple[subprocess.Popen, str]:
+    """Start the fake upstreams and main.py wired to them; returns main.py's process and URL."""
+    from fake_services import (
+        GITHUB_PROFILES, LLM_PROFILES, fake_evaluator_app, fake_github_app, fake_llm_app, free_port, start_server,
+    )
+
+    _, github_url = start_server(fake_github_app(profile_arg(GITHUB_PROFILES, args.github_profile)))
+    _, llm_url = start_server(fake_llm_app(profile_arg(LLM_PROFILES, args.llm_profile)))
+    evaluator = fake_evaluator_app()
+    _, evaluator_url = start_server(evaluator)
+
+    state_dir = tempfile.mkdtemp(prefix="bench-")
+    port = free_port()
+    env = {
+        **os.environ,
+        "GH_PERSONAL_ACCESS_TOKEN": "fake-token",
+        "AIPIPE_API_KEY": "fake-key",
+        "secret": args.secret,
+        "GITHUB_API_URL": github_url,
+        "LLM_ROUTES": json.dumps([
+            {"name": "primary", "model": "fake-primary", "url": f"{llm_url}/v1/chat/completions"},
+            {"name": "backup", "model": "fake-backup", "url": f"{llm_url}/v1/chat/completions"},
+        ]),
+        "TASK_LEDGER_PATH": os.path.join(state_dir, "tasks.db"),
+        "LLM_CACHE_DIR": os.path.join(state_dir, "llm_cache"),
+        "ATTACHMENT_STORE_DIR": os.path.join(state_dir, "attachments"),
+        "MAX_CONCURRENT_JOBS": str(args.workers),
+        "WARM_POOL_SIZE": str(args.warm_pool),
+        "PROMETHEUS_MULTIPROC_DIR": os.path.join(state_dir, "metrics"),
+    }
+    os.makedirs(env["PROMETHEUS_MULTIPROC_DIR"])
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning", "--workers", str(args.server_workers)],
+        cwd=REPO_ROOT, env=env,
+    )
+    target = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            requests.get(target, timeout=1)
+            break
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    print(f"Offline benchmark: main.py at {target}, state in {state_dir}")
+    args.evaluation_url = f"{evaluator_url}/notify"
+    return server, target
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--load", action="store_true", help="run a load test instead of one sample request")
+    parser.add_argument("--target", default="http://localhost:8000", help="main.py base URL")
+    parser.add_argument("--secret", default="hussain")
+    parser.add_argument("--evaluation-url", default="https://example.com/notify")
+    parser.add_argument("--requests", type=int, default=20, help="round 1 tasks to start")
+    parser.add_argument("--rate", type=float, default=2.0, help="tasks started per second, 0 for no pacing")
+    parser.add_argument("--concurrency", type=int, default=10, help="task units in flight at once")
+    parser.add_argument("--round2-ratio", type=float, default=0.3, help="share of tasks followed by round 2")
+    parser.add_argument("--attachment-ratio", type=float, default=0.5, help="share of round 1 tasks with an attachment")
+    parser.add_argument("--attachment-bytes", type=int, default=50_000)
+    parser.add_argument("--job-timeout", type=float, default=600)
+    parser.add_argument("--poll-interval", type=float, default=0.2)
+    parser.add_argument("--offline", action="store_true", help="run against local fake upstreams")
+    parser.add_argument("--github-profile", default="fast", help="fake GitHub profile name or JSON overrides")
+    parser.add_argument("--llm-profile", default="fast", help="fake LLM profile name or JSON overrides")
+    parser.add_argument("--workers", type=int, default=4, help="MAX_CONCURRENT_JOBS for the offline server")
+    parser.add_argument("--warm-pool", type=int, default=0, help="WARM_POOL_SIZE for the offline server")
+    parser.add_argument("--server-workers", type=int, default=1, help="uvicorn worker processes for the offline server")
+    parser.add_argument("--json", metavar="PATH", help="also write the summary to PATH")
+    args = parser.parse_args()
+
+    if not args.load:
+        send_task()
+        return
+
+    server = None
+    if args.offline:
+        server, args.target = start_offline(args)
+    try:
+        results, wall = run_load(args, args.evaluation_url)
+        summary = report(results, wall)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(summary, f, indent=2)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+
 if __name__ == "__main__":
-    send_task()
\ No newline at end of file
+    main()
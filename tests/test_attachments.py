@@ -0,0 +1,56 @@
+"""Attachments are stored when a task is submitted and found again by the stage."""
+
+import base64
+import hashlib
+
+import pytest
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "ATTACHMENT_STORE_DIR", str(tmp_path / "store"))
+    monkeypatch.setattr(main, "ATTACHMENT_MAX_BYTES", 1024)
+
+
+def data_uri(content: bytes, mime: str = "text/csv") -> str:
+    return f"data:{mime};base64,{base64.b64encode(content).decode()}"
+
+
+def test_data_attachments_become_references():
+    content = b"a,b\n1,2\n"
+    stored = main.store_request_attachments([
+        {"name": "data.csv", "url": data_uri(content)},
+        {"name": "logo.png", "url": "https://example.com/logo.png"},
+    ])
+    assert stored == [
+        {"name": "data.csv", "sha256": hashlib.sha256(content).hexdigest(), "mime": "text/csv", "size": len(content)},
+        {"name": "logo.png", "url": "https://example.com/logo.png"},
+    ]
+
+
+def test_oversized_or_malformed_attachments_are_rejected():
+    with pytest.raises(ValueError, match="big.bin"):
+        main.store_request_attachments([{"name": "big.bin", "url": data_uri(b"x" * 2048)}])
+    with pytest.raises(ValueError, match="bad.txt"):
+        main.store_request_attachments([{"name": "bad.txt", "url": "data:text/plain;base64,abcde"}])
+    with pytest.raises(ValueError):
+        main.store_request_attachments("data:text/plain,hi")
+
+
+def test_fetch_resolves_references_from_the_store():
+    stored = main.store_request_attachments([{"name": "data.csv", "url": data_uri(b"a,b\n")}])
+    [entry] = main.fetch_attachments(stored)
+    assert entry["path"] == "data.csv"
+    assert entry["mime"] == "text/csv"
+    assert entry["size"] == 4
+    with open(entry["local_path"], "rb") as f:
+        assert f.read() == b"a,b\n"
+
+
+def test_fetch_skips_references_outside_the_store():
+    assert main.fetch_attachments([
+        {"name": "gone.csv", "sha256": "0" * 64},
+        {"name": "escape", "sha256": "../../etc/passwd"},
+    ]) == []
@@ -0,0 +1,178 @@
+"""Queue, lease and cache semantics of both coordination backends.
+
+The Redis backend runs against fakeredis, so no server is needed.
+"""
+
+import threading
+import time
+
+import pytest
+
+import main
+
+SHORT_TTL = 0.05
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def backend(request, tmp_path):
+    """A factory returning clients of one shared backend, like separate worker processes."""
+    if request.param == "sqlite":
+        path = str(tmp_path / "coordination.db")
+        return lambda: main.SQLiteCoordination(path)
+    fakeredis = pytest.importorskip("fakeredis")
+    server = fakeredis.FakeServer()
+    return lambda: main.RedisCoordination(fakeredis.FakeRedis(server=server, decode_responses=True))
+
+
+@pytest.fixture
+def coord(backend):
+    return backend()
+
+
+def test_base_class_is_abstract():
+    with pytest.raises(TypeError):
+        main.Coordination()
+
+
+def test_submit_queues_each_task_once(coord):
+    assert coord.submit("t_n:1", "job-1", {"brief": "a"}) == ("job-1", None)
+    assert coord.submit("t_n:1", "job-2", {"brief": "b"}) == ("job-1", "queued")
+    assert coord.queued_count() == 1
+
+    coord.claim("w1", 60)
+    assert coord.submit("t_n:1", "job-3", {}) == ("job-1", "running")
+    assert coord.queued_count() == 0
+
+
+def test_claim_is_fifo_and_returns_the_request(coord):
+    for i in range(3):
+        coord.submit(f"k{i}", f"job-{i}", {"i": i})
+    assert coord.claim("w1", 60) == ("k0", "job-0", {"i": 0})
+    assert coord.claim("w1", 60) == ("k1", "job-1", {"i": 1})
+    assert coord.claim("w1", 60) == ("k2", "job-2", {"i": 2})
+    assert coord.claim("w1", 60) is None
+
+
+def test_heartbeat_and_finish_need_the_owner(coord):
+    coord.submit("k", "job", {})
+    key, _, _ = coord.claim("w1", 60)
+    assert coord.heartbeat(key, "w1", 60)
+    assert not coord.heartbeat(key, "w2", 60)
+    assert not coord.finish(key, "w2", "completed")
+    assert coord.finish(key, "w1", "completed")
+    assert not coord.heartbeat(key, "w1", 60)
+
+
+def test_expired_claim_is_taken_over(coord):
+    coord.submit("k", "job", {"brief": "x"})
+    coord.claim("w1", SHORT_TTL)
+    assert coord.claim("w2", 60) is None
+
+    time.sleep(SHORT_TTL * 2)
+    assert coord.claim("w2", 60) == ("k", "job", {"brief": "x"})
+    assert not coord.heartbeat("k", "w1", 60)
+    assert not coord.finish("k", "w1", "failed")
+    assert coord.heartbeat("k", "w2", 60)
+
+
+def test_heartbeat_keeps_the_claim(coord):
+    coord.submit("k", "job", {})
+    coord.claim("w1", SHORT_TTL * 4)
+    for _ in range(4):
+        time.sleep(SHORT_TTL)
+        assert coord.heartbeat("k", "w1", SHORT_TTL * 4)
+    assert coord.claim("w2", 60) is None
+
+
+def test_completed_task_is_not_queued_again(coord):
+    coord.submit("k", "job", {})
+    coord.claim("w1", 60)
+    coord.finish("k", "w1", "completed")
+    assert coord.submit("k", "other", {}) == ("job", "completed")
+    assert coord.claim("w1", 60) is None
+
+
+def test_failed_task_is_queued_again_under_its_job_id(coord):
+    coord.submit("k", "job", {"attempt": 1})
+    coord.claim("w1", 60)
+    coord.finish("k", "w1", "failed")
+    assert coord.submit("k", "other", {"attempt": 2}) == ("job", None)
+    assert coord.claim("w2", 60) == ("k", "job", {"attempt": 2})
+
+
+def test_finish_queued_hands_the_job_back(coord):
+    coord.submit("k", "job", {})
+    coord.claim("w1", 60)
+    assert coord.finish("k", "w1", "queued")
+    assert coord.queued_count() == 1
+    assert coord.claim("w2", 60) == ("k", "job", {})
+
+
+def test_lease_has_one_owner_until_released_or_expired(coord):
+    assert coord.acquire("repo:x", "a", 60)
+    assert not coord.acquire("repo:x", "b", 60)
+    assert coord.acquire("repo:x", "a", 60)
+    assert coord.renew("repo:x", "a", 60)
+    assert not coord.renew("repo:x", "b", 60)
+
+    coord.release("repo:x", "b")
+    assert not coord.acquire("repo:x", "b", 60)
+    coord.release("repo:x", "a")
+    assert coord.acquire("repo:x", "b", SHORT_TTL)
+
+    time.sleep(SHORT_TTL * 2)
+    assert not coord.renew("repo:x", "b", 60)
+    assert coord.acquire("repo:x", "a", 60)
+
+
+def test_cache_entries_expire(coord):
+    assert coord.cache_get("job:1") is None
+    coord.cache_set("job:1", '{"status": "running"}', SHORT_TTL)
+    assert coord.cache_get("job:1") == '{"status": "running"}'
+    time.sleep(SHORT_TTL * 2)
+    assert coord.cache_get("job:1") is None
+
+
+def test_concurrent_workers_never_claim_a_job_twice(backend):
+    coord = backend()
+    for i in range(200):
+        coord.submit(f"k{i}", f"job-{i}", {})
+    claimed = [[] for _ in range(6)]
+
+    def worker(n: int):
+        client = backend()
+        while (job := client.claim(f"w{n}", 60)) is not None:
+            claimed[n].append(job[0])
+            client.finish(job[0], f"w{n}", "completed")
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    keys = [key for keys in claimed for key in keys]
+    assert sorted(keys) == sorted(f"k{i}" for i in range(200))
+
+
+def test_concurrent_acquires_grant_the_lease_once(backend):
+    winners = []
+    barrier = threading.Barrier(8)
+
+    def contender(n: int):
+        client = backend()
+        barrier.wait()
+        if client.acquire("repo:x", f"w{n}", 60):
+            winners.append(n)
+
+    threads = [threading.Thread(target=contender, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(winners) == 1
+
+
+def test_coordination_from_url(tmp_path):
+    assert isinstance(main.coordination_from_url(f"sqlite:///{tmp_path / 'c.db'}"), main.SQLiteCoordination)
+    with pytest.raises(ValueError):
+        main.coordination_from_url("memcached://localhost")